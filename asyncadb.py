@@ -3,6 +3,7 @@
 # Refs adb SERVICES.TXT
 # https://github.com/aosp-mirror/platform_system_core/blob/master/adb/SERVICES.TXT
 
+import codecs
 import os
 import subprocess
 from collections import namedtuple
@@ -10,15 +11,24 @@ from collections import namedtuple
 import tornado.iostream
 from logzero import logger
 from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.queues import Queue
 from tornado.tcpclient import TCPClient
+from tornado.util import TimeoutError
 
 
 OKAY = "OKAY"
 FAIL = "FAIL"
 
+DEFAULT_TIMEOUT = 30.0  # seconds
+CHUNK_SIZE = 64 * 1024
 
-DeviceItem = namedtuple("Device", ['serial', 'status'])
-DeviceEvent = namedtuple('DeviceEvent', ['present', 'serial', 'status'])
+
+DeviceItem = namedtuple("Device", ['serial', 'status', 'usb'],
+                        defaults=[None])
+DeviceEvent = namedtuple('DeviceEvent',
+                         ['present', 'serial', 'status', 'origin', 'usb'],
+                         defaults=[None, None])
 ForwardItem = namedtuple("ForwardItem", ['serial', 'local', 'remote'])
 
 
@@ -26,28 +36,56 @@ class AdbError(Exception):
     """ adb error """
 
 
+class AdbTimeout(AdbError):
+    """ adb command not finished before deadline """
+
+
 class AdbStreamConnection(tornado.iostream.IOStream):
     """
     Example usgae:
         async with AdbStreamConnection(host, port) as c:
             c.send_cmd("host:kill")
+
+    When timeout is set, all operations on this connection share one
+    deadline. Once passed, the stream is closed and AdbTimeout raised.
     """
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, timeout: float = None):
         self.__host = host
         self.__port = port
         self.__stream = None
+        self.__timeout = timeout
+        self.__deadline = None
 
     @property
     def stream(self):
         return self.__stream
 
+    async def _wait(self, future):
+        if self.__deadline is None:
+            return await future
+        try:
+            return await gen.with_timeout(
+                self.__deadline,
+                future,
+                quiet_exceptions=(tornado.iostream.StreamClosedError, ))
+        except TimeoutError:
+            self.close()
+            raise AdbTimeout("timeout after %.1fs" % self.__timeout)
+
     async def send_cmd(self, cmd: str):
-        await self.stream.write("{:04x}{}".format(len(cmd),
-                                                  cmd).encode('utf-8'))
+        await self._wait(
+            self.stream.write("{:04x}{}".format(len(cmd),
+                                                cmd).encode('utf-8')))
+
+    async def read_raw(self, num: int, partial=False) -> bytes:
+        return await self._wait(self.stream.read_bytes(num, partial=partial))
 
     async def read_bytes(self, num: int):
-        return (await self.stream.read_bytes(num)).decode()
+        return (await self.read_raw(num)).decode()
+
+    async def read_until_close(self) -> bytes:
+        return await self._wait(self.stream.read_until_close())
 
     async def read_string(self):
         lenstr = await self.read_bytes(4)
@@ -68,26 +106,72 @@ class AdbStreamConnection(tornado.iostream.IOStream):
             "ANDROID_ADB_SERVER_HOST", "127.0.0.1")
         adb_port = self.__port or int(os.environ.get(
             "ANDROID_ADB_SERVER_PORT", 5037))
-        stream = await TCPClient().connect(adb_host, adb_port)
+        if self.__timeout is not None:
+            self.__deadline = IOLoop.current().time() + self.__timeout
+        try:
+            stream = await TCPClient().connect(adb_host,
+                                               adb_port,
+                                               timeout=self.__timeout)
+        except TimeoutError:
+            raise AdbTimeout("connect %s:%d timeout" % (adb_host, adb_port))
         self.__stream = stream
         return self
 
+    def close(self):
+        if self.__stream:
+            self.__stream.close()
+
     async def __aenter__(self):
         return await self.connect()
 
     async def __aexit__(self, exc_type, exc, tb):
-        self.stream.close()
+        # also reached when the calling coroutine is cancelled
+        self.close()
 
 
 class AdbClient(object):
-    def __init__(self):
+    def __init__(self,
+                 host: str = None,
+                 port: int = None,
+                 timeout: float = DEFAULT_TIMEOUT):
+        """
+        Args:
+            host, port: adb server address, default from env
+                ANDROID_ADB_SERVER_HOST and ANDROID_ADB_SERVER_PORT
+            timeout: default deadline(seconds) of each command,
+                None means wait forever
+        """
         self._stream = None
+        self.host = host
+        self.port = port
+        self.timeout = timeout
 
-    def connect(self, host=None, port=None) -> AdbStreamConnection:
-        return AdbStreamConnection(host, port)
+    @property
+    def origin(self) -> str:
+        """ adb server address, host:port """
+        host = self.host or os.environ.get("ANDROID_ADB_SERVER_HOST",
+                                           "127.0.0.1")
+        port = self.port or int(
+            os.environ.get("ANDROID_ADB_SERVER_PORT", 5037))
+        return "%s:%d" % (host, port)
 
-    async def server_version(self) -> int:
-        async with self.connect() as c:
+    @property
+    def is_local(self) -> bool:
+        return self.origin.rsplit(":", 1)[0] in ("127.0.0.1", "localhost")
+
+    def connect(self, host=None, port=None,
+                timeout: float = None) -> AdbStreamConnection:
+        return AdbStreamConnection(host or self.host, port or self.port,
+                                   timeout)
+
+    def _connect(self, timeout: float = None) -> AdbStreamConnection:
+        """ connect with per-call timeout, fallback to default timeout """
+        if timeout is None:
+            timeout = self.timeout
+        return self.connect(timeout=timeout)
+
+    async def server_version(self, timeout: float = None) -> int:
+        async with self._connect(timeout) as c:
             await c.send_cmd("host:version")
             await c.check_okay()
             return int(await c.read_string(), 16)
@@ -110,21 +194,36 @@ class AdbClient(object):
                     for evt in self._diff_devices(orig_devices, curr_devices):
                         yield evt
                     orig_devices = curr_devices
-            except tornado.iostream.StreamClosedError:
+            except (tornado.iostream.StreamClosedError, AdbTimeout):
                 # adb server maybe killed
                 for evt in self._diff_devices(orig_devices, []):
                     yield evt
                 orig_devices = []
 
                 sleep = 1.0
-                logger.info(
-                    "adb connection is down, retry after %.1fs" % sleep)
+                logger.info("adb connection %s is down, retry after %.1fs",
+                            self.origin, sleep)
                 await gen.sleep(sleep)
+                if not self.is_local:
+                    continue
                 subprocess.run(['adb', 'start-server'])
                 version = await self.server_version()
                 logger.info("adb-server started, version: %d", version)
 
     async def _unsafe_track_devices(self):
+        async with self.connect() as conn:
+            # long format contains usb path, eg: usb:1-1.4
+            await conn.send_cmd("host:track-devices-l")
+            try:
+                await conn.check_okay()
+            except AdbError:  # adb too old
+                async for content in self._unsafe_track_devices_short():
+                    yield content
+                return
+            while True:
+                yield await conn.read_string()
+
+    async def _unsafe_track_devices_short(self):
         async with self.connect() as conn:
             await conn.send_cmd("host:track-devices")
             await conn.check_okay()
@@ -134,9 +233,9 @@ class AdbClient(object):
     def _diff_devices(self, orig_devices: list, curr_devices: list):
         """ Return iter(DeviceEvent) """
         for d in set(orig_devices).difference(curr_devices):
-            yield DeviceEvent(False, d.serial, d.status)
+            yield DeviceEvent(False, d.serial, d.status, self.origin, d.usb)
         for d in set(curr_devices).difference(orig_devices):
-            yield DeviceEvent(True, d.serial, d.status)
+            yield DeviceEvent(True, d.serial, d.status, self.origin, d.usb)
 
     def output2devices(self, output: str, limit_status=[]):
         """
@@ -148,29 +247,96 @@ class AdbClient(object):
         """
         results = []
         for line in output.splitlines():
-            fields = line.strip().split("\t", maxsplit=1)
-            if len(fields) != 2:
+            usb = None
+            if "\t" in line:
+                fields = line.strip().split("\t", maxsplit=1)
+            else:  # long format: <serial> <status> usb:1-1.4 product:xx ...
+                fields = line.split()
+                for field in fields[2:]:
+                    if field.startswith("usb:"):
+                        usb = field[len("usb:"):]
+            if len(fields) < 2:
                 continue
             serial, status = fields[0], fields[1]
 
             if limit_status:
                 if status in limit_status:
-                    results.append(DeviceItem(serial, status))
+                    results.append(DeviceItem(serial, status, usb))
             else:
-                results.append(DeviceItem(serial, status))
+                results.append(DeviceItem(serial, status, usb))
         return results
 
-    async def shell(self, serial: str, command: str):
-        async with self.connect() as conn:
-            await conn.send_cmd("host:transport:"+serial)
-            await conn.check_okay()
-            await conn.send_cmd("shell:"+command)
-            await conn.check_okay()
-            output = await conn.stream.read_until_close()
+    async def _open_shell(self, conn: AdbStreamConnection, serial: str,
+                          command: str):
+        await conn.send_cmd("host:transport:"+serial)
+        await conn.check_okay()
+        await conn.send_cmd("shell:"+command)
+        await conn.check_okay()
+
+    async def shell(self, serial: str, command: str, timeout: float = None):
+        async with self._connect(timeout) as conn:
+            await self._open_shell(conn, serial, command)
+            output = await conn.read_until_close()
             return output.decode('utf-8')
 
-    async def forward_list(self):
-        async with self.connect() as conn:
+    async def shell_stream(self,
+                           serial: str,
+                           command: str,
+                           lines: bool = False,
+                           raw: bool = False,
+                           chunk_size: int = CHUNK_SIZE,
+                           timeout: float = None):
+        """
+        yield shell output as it arrives
+
+        Args:
+            lines: yield lines (without line ending) instead of chunks
+            raw: yield bytes instead of str
+            chunk_size: max bytes buffered, a line longer than this is
+                yielded in pieces
+            timeout: deadline of the whole command, default no limit
+
+        Example:
+            async for line in adb.shell_stream(serial, "logcat", lines=True):
+                print(line)
+
+        Data is read from the socket only when the consumer asks for more,
+        so a slow consumer applies backpressure to the device.
+        """
+        decoder = None
+        if not raw:
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+        def decode(data: bytes, final=False):
+            return data if raw else decoder.decode(data, final)
+
+        async with self.connect(timeout=timeout) as conn:
+            await self._open_shell(conn, serial, command)
+            buf = b""
+            while True:
+                try:
+                    data = await conn.read_raw(chunk_size, partial=True)
+                except tornado.iostream.StreamClosedError:
+                    break
+                if not lines:
+                    yield decode(data)
+                    continue
+                buf += data
+                *parts, buf = buf.split(b"\n")
+                for part in parts:
+                    yield decode(part.rstrip(b"\r"), True)
+                if len(buf) >= chunk_size:
+                    yield decode(buf)
+                    buf = b""
+            if lines and buf:
+                yield decode(buf.rstrip(b"\r"), True)
+            elif not lines and not raw:
+                tail = decoder.decode(b"", True)
+                if tail:
+                    yield tail
+
+    async def forward_list(self, timeout: float = None):
+        async with self._connect(timeout) as conn:
             # adb 1.0.40 not support host-local
             await conn.send_cmd("host:list-forward")
             await conn.check_okay()
@@ -181,23 +347,25 @@ class AdbClient(object):
                     continue
                 yield ForwardItem(*parts)
 
-    async def forward_remove(self, local=None):
-        async with self.connect() as conn:
+    async def forward_remove(self, local=None, timeout: float = None):
+        async with self._connect(timeout) as conn:
             if local:
                 await conn.send_cmd("host:killforward:"+local)
             else:
                 await conn.send_cmd("host:killforward-all")
             await conn.check_okay()
 
-    async def forward(self, serial: str, local: str, remote: str, norebind=False):
+    async def forward(self, serial: str, local: str, remote: str, norebind=False,
+                      timeout: float = None):
         """
         Args:
             serial: device serial
             local, remote (str): tcp:<port> | localabstract:<name>
             norebind(bool): set to true will fail it when 
                     there is already a forward connection from <local>
+            timeout(float): seconds, default self.timeout
         """
-        async with self.connect() as conn:
+        async with self._connect(timeout) as conn:
             cmds = ["host-serial", serial, "forward"]
             if norebind:
                 cmds.append('norebind')
@@ -205,12 +373,12 @@ class AdbClient(object):
             await conn.send_cmd(":".join(cmds))
             await conn.check_okay()
 
-    async def devices(self):
+    async def devices(self, timeout: float = None):
         """
         Return:
             list of devices
         """
-        async with self.connect() as conn:
+        async with self._connect(timeout) as conn:
             await conn.send_cmd("host:devices")
             await conn.check_okay()
             content = await conn.read_string()
@@ -218,3 +386,65 @@ class AdbClient(object):
 
 
 adb = AdbClient()
+_clients = {}  # origin -> AdbClient
+
+
+def get_client(origin: str = None) -> AdbClient:
+    """
+    Args:
+        origin: adb server address host:port, None for the default client
+    """
+    if not origin or origin == adb.origin:
+        return adb
+    if origin not in _clients:
+        host, port = origin.rsplit(":", 1)
+        _clients[origin] = AdbClient(host, int(port))
+    return _clients[origin]
+
+
+async def track_devices_all(clients: list):
+    """
+    merge track_devices of several adb servers, DeviceEvent.origin tells
+    which server the device belongs to
+    """
+    queue = Queue(maxsize=len(clients))
+
+    async def drain(client: AdbClient):
+        async for event in client.track_devices():
+            await queue.put(event)
+
+    for client in clients:
+        IOLoop.current().spawn_callback(drain, client)
+
+    # devices are identified by serial, the same serial on two servers
+    # (e.g. emulator-5554, or cheap phones all reporting 0123456789ABCDEF)
+    # would overwrite each other. The first one wins, the other is held
+    # back until the first one is removed.
+    owners = {}  # serial -> origin
+    shadowed = {}  # serial -> {origin: DeviceEvent}
+    while True:
+        event = await queue.get()
+        owner = owners.get(event.serial)
+        if event.present:
+            if owner is None or owner == event.origin:
+                owners[event.serial] = event.origin
+                yield event
+            else:
+                logger.warning(
+                    "Device %s of %s ignored, serial already used by %s",
+                    event.serial, event.origin, owner)
+                shadowed.setdefault(event.serial, {})[event.origin] = event
+        elif owner != event.origin:
+            shadowed.get(event.serial, {}).pop(event.origin, None)
+        else:
+            del owners[event.serial]
+            yield event
+            others = shadowed.get(event.serial)
+            if others:
+                _, event = others.popitem()
+                if not others:
+                    del shadowed[event.serial]
+                owners[event.serial] = event.origin
+                logger.info("Device %s of %s takes over the serial",
+                            event.serial, event.origin)
+                yield event
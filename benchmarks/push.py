@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Benchmark gzip compressed push (core.gzpush) against plain sync.push.
+#
+# By default files are pushed to a fake device: a local directory behind a
+# link throttled to --link-speed, shell commands (gzip -d, chmod, rm) run on
+# the host, slowed down by --device-cpu to look like a phone. The real
+# GzipPusher code path is used for both modes.
+#
+# Usage:
+#   python3 benchmarks/push.py vendor/*.apk atx-agent minicap
+#   python3 benchmarks/push.py --link-speed 10,20,40 -o result.json FILE...
+#   python3 benchmarks/push.py --serial 3578298f FILE...    # real device
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import logzero
+
+__curdir__ = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(__curdir__))
+
+from core import gzpush  # noqa: E402
+import settings  # noqa: E402
+
+DEVICE_DIR = "/data/local/tmp"
+
+
+class FakeSync(object):
+    def __init__(self, device):
+        self._device = device
+
+    def push(self, src, dst: str, mode: int = 0o755) -> int:
+        if isinstance(src, (bytes, bytearray)):
+            data, src = bytes(src), None
+        start = time.perf_counter()
+        sent = 0
+        with open(self._device.local_path(dst), "wb") as f:
+            while True:
+                chunk = data if src is None else src.read(4096)
+                data = b""
+                if not chunk:
+                    break
+                f.write(chunk)
+                sent += len(chunk)
+                # bytes can not arrive earlier than the link allows
+                arrive = start + sent / self._device.link_speed
+                delay = arrive - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        os.chmod(self._device.local_path(dst), mode)
+        return sent
+
+
+class FakeDevice(object):
+    """ directory on host which plays /data/local/tmp of a device """
+
+    def __init__(self, root: str, link_speed: float, cpu_factor: float):
+        self.serial = "fake-%d" % int(link_speed)
+        self.root = root
+        self.link_speed = link_speed
+        self.cpu_factor = cpu_factor
+        self.sync = FakeSync(self)
+
+    def local_path(self, path: str) -> str:
+        return path.replace(DEVICE_DIR, self.root)
+
+    def shell(self, cmd) -> str:
+        if isinstance(cmd, list):
+            cmd = " ".join(cmd)
+        start = time.perf_counter()
+        p = subprocess.run(self.local_path(cmd),
+                           shell=True,
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT)
+        elapsed = time.perf_counter() - start
+        time.sleep(elapsed * (self.cpu_factor - 1))
+        return p.stdout.decode(errors="replace")
+
+
+def push_once(pusher, device, path: str, mode: str) -> dict:
+    settings.push_compress = mode
+    dst = DEVICE_DIR + "/bench-" + os.path.basename(path)
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        start = time.perf_counter()
+        compressed = pusher.push(device, f, dst, 0o644, size)
+        elapsed = time.perf_counter() - start
+    device.shell(["rm", "-f", dst])
+    return {
+        "seconds": elapsed,
+        "MBps": size / elapsed / (1 << 20),
+        "compressed": compressed,
+    }
+
+
+def auto_choice(pusher, device, path: str) -> bool:
+    """ what auto mode picks, with the link speed already known """
+    settings.push_compress = gzpush.MODE_AUTO
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        return pusher._should_compress(device, f, size)
+
+
+def bench_file(device, path: str, repeat: int) -> dict:
+    pusher = gzpush.GzipPusher()
+    pusher._gzip_supported(device)  # probe is not part of the timing
+    pusher._speeds[device.serial] = getattr(device, "link_speed",
+                                            gzpush.DEFAULT_LINK_SPEED)
+    with open(path, "rb") as f:
+        ratio, _ = gzpush.estimate(f, os.path.getsize(path))
+    result = {
+        "file": path,
+        "bytes": os.path.getsize(path),
+        "estimated_ratio": ratio,
+        "auto_compress": auto_choice(pusher, device, path),
+    }
+    for mode in (gzpush.MODE_NEVER, gzpush.MODE_ALWAYS):
+        runs = [push_once(pusher, device, path, mode) for _ in range(repeat)]
+        best = min(runs, key=lambda r: r["seconds"])
+        result["plain" if mode == gzpush.MODE_NEVER else "gzip"] = best
+    result["speedup"] = result["plain"]["seconds"] / result["gzip"]["seconds"]
+    return result
+
+
+def print_result(r: dict):
+    print("%-40s %8.1fMB  ratio %.2f  plain %6.2fs  gzip %6.2fs%s  x%.2f  "
+          "auto: %s" %
+          (r["file"][-40:], r["bytes"] / (1 << 20),
+           r["estimated_ratio"], r["plain"]["seconds"],
+           r["gzip"]["seconds"], "" if r["gzip"]["compressed"] else "(n/a)",
+           r["speedup"], "gzip" if r["auto_compress"] else "plain"))
+
+
+@contextlib.contextmanager
+def fake_device(link_speed: float, cpu_factor: float):
+    root = tempfile.mkdtemp(prefix="fake-device-")
+    try:
+        yield FakeDevice(root, link_speed, cpu_factor)
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    # yapf: disable
+    parser.add_argument("files", nargs="+", help="files to push")
+    parser.add_argument("--link-speed", default="10,20,40", help="comma separated MB/s of the fake usb link")
+    parser.add_argument("--device-cpu", type=float, default=4.0, help="fake device runs shell commands N times slower than host")
+    parser.add_argument("-s", "--serial", help="push to a real device instead of the fake one")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each file and mode, best one is reported")
+    parser.add_argument("-o", "--output", help="write json result to file")
+    args = parser.parse_args()
+    # yapf: enable
+    logzero.loglevel(logzero.logging.INFO)
+
+    report = {
+        "params": {
+            "device_cpu": args.device_cpu,
+            "repeat": args.repeat,
+            "level": gzpush.LEVEL,
+        },
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+        },
+        "results": [],
+    }
+    if args.serial:
+        import adbutils
+        device = adbutils.adb.device(args.serial)
+        print("Device:", args.serial)
+        for path in args.files:
+            r = bench_file(device, path, args.repeat)
+            report["results"].append(r)
+            print_result(r)
+    else:
+        for speed in [float(v) for v in args.link_speed.split(",") if v]:
+            print("Fake device, link %.1f MB/s" % speed)
+            with fake_device(speed * (1 << 20), args.device_cpu) as device:
+                for path in args.files:
+                    r = bench_file(device, path, args.repeat)
+                    r["link_MBps"] = speed
+                    report["results"].append(r)
+                    print_result(r)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+        print("Result saved to", args.output)
+
+
+if __name__ == "__main__":
+    main()
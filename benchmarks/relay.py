@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Benchmark the tcp relay which proxy_device_port starts in front of
+# atx-agent(:7912) and WhatsInput(:6677).
+#
+# The relay is started exactly like AndroidDevice.proxy_device_port does,
+# but the remote end is a local server instead of an adb forward, so the
+# numbers only contain the cost of the relay itself.
+#
+# Usage:
+#   python3 benchmarks/relay.py
+#   python3 benchmarks/relay.py -c 1,10,100,1000 --bytes 4M -o result.json
+#   python3 benchmarks/relay.py --relay none      # baseline, no relay
+#   python3 benchmarks/relay.py --relay "python3 myrelay.py {listen} {host} {port}"
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shlex
+import struct
+import subprocess
+import sys
+import time
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.netutil import bind_sockets
+from tornado.tcpclient import TCPClient
+from tornado.tcpserver import TCPServer
+
+__curdir__ = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(__curdir__))
+
+from core.freeport import freeport  # noqa: E402
+
+RELAYS = {
+    "node": "node tcpproxy.js {listen} {host} {port}",
+}
+
+OP_UPLOAD = b"U"
+OP_DOWNLOAD = b"D"
+OP_ECHO = b"E"
+HEADER = struct.Struct(">cQ")
+CHUNK_SIZE = 64 * 1024
+BACKLOG = 4096  # the default 128 drops connects at high concurrency
+
+
+class BenchServer(TCPServer):
+    """
+    Upstream server which plays the role of atx-agent.
+
+    Every connection starts with a header (op, length)
+        U: read <length> bytes, then reply 8 bytes of received size
+        D: write <length> bytes
+        E: echo everything until the peer closes
+    """
+
+    def __init__(self, payload: bytes):
+        super().__init__()
+        self._payload = payload
+
+    async def handle_stream(self, stream, address):
+        try:
+            op, length = HEADER.unpack(await stream.read_bytes(HEADER.size))
+            if op == OP_UPLOAD:
+                received = 0
+                while received < length:
+                    data = await stream.read_bytes(
+                        min(CHUNK_SIZE, length - received), partial=True)
+                    received += len(data)
+                await stream.write(struct.pack(">Q", received))
+            elif op == OP_DOWNLOAD:
+                await write_payload(stream, self._payload, length)
+            elif op == OP_ECHO:
+                while True:
+                    data = await stream.read_bytes(CHUNK_SIZE, partial=True)
+                    await stream.write(data)
+        except StreamClosedError:
+            pass
+        finally:
+            stream.close()
+
+
+def make_payload(seed: int) -> bytes:
+    rnd = random.Random(seed)
+    return bytes(rnd.getrandbits(8) for _ in range(CHUNK_SIZE))
+
+
+def run_server(port: int, seed: int):
+    """
+    entry of the server process, so that the server does not compete with
+    the clients for the cpu of one python process
+    """
+    server = BenchServer(make_payload(seed))
+    server.add_sockets(bind_sockets(port, "127.0.0.1", backlog=BACKLOG))
+    IOLoop.current().start()
+
+
+async def write_payload(stream, payload: bytes, length: int):
+    sent = 0
+    while sent < length:
+        chunk = payload[:min(len(payload), length - sent)]
+        await stream.write(chunk)
+        sent += len(chunk)
+
+
+async def read_exactly(stream, length: int):
+    received = 0
+    while received < length:
+        data = await stream.read_bytes(
+            min(CHUNK_SIZE, length - received), partial=True)
+        received += len(data)
+    return received
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(pct / 100.0 * len(values))) - 1))
+    return values[k]
+
+
+def parse_size(text: str) -> int:
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def proc_cpu_seconds(pid: int):
+    """ user+system cpu time of pid, None if /proc is not available """
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    return (int(fields[11]) + int(fields[12])) / ticks
+
+
+def raise_nofile_limit(need: int):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft >= need:
+        return
+    target = need if hard == resource.RLIM_INFINITY else min(need, hard)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    if target < need:
+        print("WARN: RLIMIT_NOFILE %d is less than required %d" %
+              (target, need))
+
+
+async def wait_port(host: str, port: int, timeout: float = 10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            stream = await TCPClient().connect(host, port)
+            stream.close()
+            return
+        except (OSError, StreamClosedError):
+            await gen.sleep(.05)
+    raise RuntimeError("port %d not ready after %.1fs" % (port, timeout))
+
+
+class Relay(object):
+    def __init__(self, cmd_template: str, host: str, port: int):
+        self._template = cmd_template
+        self._host = host
+        self._port = port
+        self._proc = None
+        self.port = port
+
+    async def start(self):
+        if not self._template:  # direct connect, baseline
+            return
+        self.port = freeport.get()
+        cmd = self._template.format(
+            listen=self.port, host=self._host, port=self._port)
+        self._proc = subprocess.Popen(
+            shlex.split(cmd),
+            cwd=os.path.dirname(__curdir__),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        await wait_port("127.0.0.1", self.port)
+
+    def cpu_seconds(self):
+        if not self._proc:
+            return 0.0
+        return proc_cpu_seconds(self._proc.pid)
+
+    def stop(self):
+        """ Returns: total cpu seconds of relay process """
+        if not self._proc:
+            return 0.0
+        self._proc.terminate()
+        _, _, rusage = os.wait4(self._proc.pid, 0)
+        self._proc.returncode = 0
+        self._proc = None
+        return rusage.ru_utime + rusage.ru_stime
+
+
+async def open_conn(port: int, op: bytes, length: int):
+    start = time.perf_counter()
+    stream = await TCPClient().connect("127.0.0.1", port)
+    stream.set_nodelay(True)
+    await stream.write(HEADER.pack(op, length))
+    return stream, time.perf_counter() - start
+
+
+async def run_latency(port: int, rounds: int, msg: bytes):
+    stream, connect_time = await open_conn(port, OP_ECHO, 0)
+    rtts = []
+    try:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            await stream.write(msg)
+            await read_exactly(stream, len(msg))
+            rtts.append(time.perf_counter() - start)
+    finally:
+        stream.close()
+    return connect_time, rtts
+
+
+async def run_upload(port: int, payload: bytes, length: int):
+    stream, _ = await open_conn(port, OP_UPLOAD, length)
+    try:
+        await write_payload(stream, payload, length)
+        received, = struct.unpack(">Q", await stream.read_bytes(8))
+    finally:
+        stream.close()
+    assert received == length, "upload size mismatch"
+    return length
+
+
+async def run_download(port: int, length: int):
+    stream, _ = await open_conn(port, OP_DOWNLOAD, length)
+    try:
+        return await read_exactly(stream, length)
+    finally:
+        stream.close()
+
+
+async def attempts(coros: list):
+    """ Returns: (results of succeeded ones, number of failed ones) """
+    async def attempt(coro):
+        try:
+            return True, await coro
+        except (OSError, StreamClosedError, AssertionError):
+            return False, None
+
+    outcomes = await gen.multi([attempt(coro) for coro in coros])
+    results = [value for ok, value in outcomes if ok]
+    return results, len(outcomes) - len(results)
+
+
+async def bench_level(relay: Relay, concurrency: int, args, payload: bytes):
+    result = {"concurrency": concurrency, "failed": {}}
+
+    msg = payload[:args.msg_size]
+    samples, result["failed"]["latency"] = await attempts([
+        run_latency(relay.port, args.rounds, msg) for _ in range(concurrency)
+    ])
+    connects = [s[0] * 1000 for s in samples]
+    rtts = [rtt * 1000 for s in samples for rtt in s[1]]
+    result["connect_ms"] = {
+        "p50": percentile(connects, 50),
+        "p99": percentile(connects, 99),
+    }
+    result["rtt_ms"] = {
+        "p50": percentile(rtts, 50),
+        "p90": percentile(rtts, 90),
+        "p99": percentile(rtts, 99),
+        "max": max(rtts) if rtts else 0.0,
+    }
+
+    for direction in ("upload", "download"):
+        cpu_before = relay.cpu_seconds()
+        start = time.perf_counter()
+        if direction == "upload":
+            futures = [
+                run_upload(relay.port, payload, args.bytes)
+                for _ in range(concurrency)
+            ]
+        else:
+            futures = [
+                run_download(relay.port, args.bytes)
+                for _ in range(concurrency)
+            ]
+        sizes, result["failed"][direction] = await attempts(futures)
+        total = sum(sizes)
+        elapsed = time.perf_counter() - start
+        cpu_after = relay.cpu_seconds()
+        cpu = None
+        if cpu_before is not None and cpu_after is not None:
+            cpu = cpu_after - cpu_before
+        result[direction] = {
+            "bytes": total,
+            "seconds": elapsed,
+            "MBps": total / elapsed / (1 << 20),
+            "relay_cpu_seconds": cpu,
+            "relay_cpu_seconds_per_GB":
+            None if cpu is None or not total else cpu / (total / (1 << 30)),
+        }
+    return result
+
+
+def print_result(r: dict):
+    def cpu_per_gb(d):
+        v = d["relay_cpu_seconds_per_GB"]
+        return "-" if v is None else "%.2f" % v
+
+    print("%6d  conn p50/p99 %6.2f/%6.2fms  rtt p50/p99 %6.2f/%7.2fms  "
+          "up %8.1fMB/s (cpu/GB %s)  down %8.1fMB/s (cpu/GB %s)" %
+          (r["concurrency"], r["connect_ms"]["p50"], r["connect_ms"]["p99"],
+           r["rtt_ms"]["p50"], r["rtt_ms"]["p99"], r["upload"]["MBps"],
+           cpu_per_gb(r["upload"]), r["download"]["MBps"],
+           cpu_per_gb(r["download"])))
+    failed = sum(r["failed"].values())
+    if failed:
+        print("        failed connections: %s" % r["failed"])
+
+
+def node_version():
+    try:
+        return subprocess.check_output(["node", "--version"]).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def async_main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    # yapf: disable
+    parser.add_argument("-c", "--concurrency", default="1,10,100,1000", help="comma separated concurrent connections")
+    parser.add_argument("-r", "--relay", default="node", help="node, none or a command template with {listen} {host} {port}")
+    parser.add_argument("--bytes", type=parse_size, default="1M", help="bytes transfered by each connection in each direction")
+    parser.add_argument("--rounds", type=int, default=20, help="ping-pong rounds for each connection")
+    parser.add_argument("--msg-size", type=int, default=64, help="ping-pong message size")
+    parser.add_argument("--seed", type=int, default=0, help="payload random seed")
+    parser.add_argument("-o", "--output", help="write json result to file")
+    args = parser.parse_args()
+    # yapf: enable
+
+    levels = [int(v) for v in args.concurrency.split(",") if v.strip()]
+    template = RELAYS.get(args.relay, args.relay)
+    if args.relay == "none":
+        template = ""
+
+    # client + relay(both sides) + server
+    raise_nofile_limit(max(levels) * 4 + 256)
+
+    payload = make_payload(args.seed)
+
+    server_port = freeport.get()
+    server = multiprocessing.get_context("spawn").Process(
+        target=run_server, args=(server_port, args.seed), daemon=True)
+    server.start()
+    await wait_port("127.0.0.1", server_port)
+
+    report = {
+        "relay": template or "none",
+        "params": {
+            "bytes": args.bytes,
+            "rounds": args.rounds,
+            "msg_size": args.msg_size,
+            "seed": args.seed,
+        },
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "node": node_version(),
+            "cpus": os.cpu_count(),
+        },
+        "results": [],
+    }
+    print("Relay:", report["relay"])
+    for concurrency in levels:
+        relay = Relay(template, "127.0.0.1", server_port)
+        await relay.start()
+        try:
+            result = await bench_level(relay, concurrency, args, payload)
+        finally:
+            cpu_seconds = relay.stop()
+        result["relay_cpu_seconds_total"] = cpu_seconds
+        report["results"].append(result)
+        print_result(result)
+
+    server.terminate()
+    server.join()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+        print("Result saved to", args.output)
+
+
+if __name__ == "__main__":
+    IOLoop.current().run_sync(async_main)
@@ -0,0 +1,101 @@
+# coding: utf-8
+#
+# Apks cached on the device, named by sha256 of the content.
+#
+# Installing a build which was pushed before (e.g. again after a cold reset)
+# needs no usb transfer. Each device keeps at most
+# settings.device_apk_cache_size bytes, least recently used apks are removed
+# first. The index lives in core.devicestore, a cached file is checked with
+# stat before reuse in case the device storage was wiped.
+
+import threading
+import time
+
+from logzero import logger
+
+from core.devicestore import devicestore
+import settings
+
+CACHE_DIR = "/data/local/tmp/apk-cache"
+
+
+class ApkCache(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cleaned = set()  # serials whose old tmp-*.apk were removed
+
+    def remote_path(self, digest: str) -> str:
+        return "%s/%s.apk" % (CACHE_DIR, digest)
+
+    def lookup(self, device, digest: str, size: int):
+        """
+        Args:
+            device: adbutils device
+
+        Returns:
+            remote path of the cached apk, or None
+        """
+        if not any(d == digest for d, _, _ in
+                   devicestore.cached_apks(device.serial)):
+            return None
+        path = self.remote_path(digest)
+        if device.shell(["stat", "-c", "%s", path]).strip() != str(size):
+            logger.debug("[%s] cached apk %s is gone", device.serial, digest)
+            devicestore.drop_apk(device.serial, digest)
+            return None
+        devicestore.touch_apk(device.serial, digest, size)
+        return path
+
+    def store(self, device, digest: str, size: int, push) -> str:
+        """
+        Args:
+            push: func(remote_path) which uploads the apk
+
+        Returns:
+            remote path, call release() with it after install
+        """
+        self._remove_tmp_apks(device)
+        if size > settings.device_apk_cache_size:  # also when cache disabled
+            path = "/data/local/tmp/tmp-%d.apk" % int(time.time() * 1000)
+            push(path)
+            return path
+
+        self._evict(device, size)
+        path = self.remote_path(digest)
+        device.shell(["mkdir", "-p", CACHE_DIR])
+        push(path + ".tmp")  # not visible to lookup until complete
+        device.shell(["mv", path + ".tmp", path])
+        devicestore.touch_apk(device.serial, digest, size)
+        return path
+
+    def release(self, device, path: str):
+        """ remove the apk if it was not kept in cache """
+        if not path.startswith(CACHE_DIR + "/"):
+            device.shell(["rm", "-f", path])
+
+    def _evict(self, device, incoming: int):
+        entries = devicestore.cached_apks(device.serial)
+        total = sum(size for _, size, _ in entries) + incoming
+        victims = []
+        for digest, size, _ in entries:
+            if total <= settings.device_apk_cache_size:
+                break
+            victims.append(digest)
+            total -= size
+        if not victims:
+            return
+        logger.debug("[%s] evict cached apks: %s", device.serial, victims)
+        device.shell(["rm", "-f"] + [self.remote_path(d) for d in victims])
+        for digest in victims:
+            devicestore.drop_apk(device.serial, digest)
+
+    def _remove_tmp_apks(self, device):
+        """ tmp-<ms>.apk left by older versions were never removed """
+        with self._lock:
+            if device.serial in self._cleaned:
+                return
+            self._cleaned.add(device.serial)
+        device.shell("rm -f /data/local/tmp/tmp-*.apk " + CACHE_DIR + "/*.tmp")
+
+
+apkcache = ApkCache()
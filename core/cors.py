@@ -0,0 +1,18 @@
+# coding: utf-8
+#
+
+class CorsMixin(object):
+    CORS_ORIGIN = '*'
+    CORS_METHODS = 'GET,POST,OPTIONS'
+    CORS_CREDENTIALS = True
+    CORS_HEADERS = "x-requested-with,authorization"
+
+    def set_default_headers(self):
+        self.set_header("Access-Control-Allow-Origin", self.CORS_ORIGIN)
+        self.set_header("Access-Control-Allow-Headers", self.CORS_HEADERS)
+        self.set_header('Access-Control-Allow-Methods', self.CORS_METHODS)
+
+    def options(self):
+        # no body
+        self.set_status(204)
+        self.finish()
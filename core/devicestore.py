@@ -0,0 +1,152 @@
+# coding: utf-8
+#
+# Remember which apks were already verified on each device, so that a
+# provider restart does not need to parse every apk and ask the package
+# manager for its version again, a cheap package list is enough.
+#
+# Records are keyed by (serial, ro.build.fingerprint), an OTA update or
+# factory image change will invalidate them automatically.
+#
+# It also keeps small json states of each device (e.g. background helper
+# processes) which can be adopted by the next provider process, and the
+# index of apks cached on each device (see core.apkcache).
+
+import json
+import sqlite3
+import threading
+import time
+
+import settings
+
+
+class DeviceStore(object):
+    def __init__(self, path: str = None):
+        self._path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self._path or settings.state_db_path,
+                                         check_same_thread=False)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS verified (
+                    serial TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    target TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (serial, fingerprint, target)
+                )""")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS state (
+                    serial TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (serial, key)
+                )""")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS apk_cache (
+                    serial TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    used REAL NOT NULL,
+                    PRIMARY KEY (serial, digest)
+                )""")
+            self._conn.commit()
+        return self._conn
+
+    def verified_target(self, serial: str, fingerprint: str,
+                        digest: str):
+        """
+        Args:
+            digest: identity of the local artifact
+
+        Returns:
+            target (e.g. package name) verified with it, None if not found
+        """
+        if not fingerprint:
+            return None
+        with self._lock:
+            row = self._db().execute(
+                "SELECT target FROM verified "
+                "WHERE serial=? AND fingerprint=? AND digest=? "
+                "ORDER BY updated DESC",
+                (serial, fingerprint, digest)).fetchone()
+        return row[0] if row else None
+
+    def mark_verified(self, serial: str, fingerprint: str, target: str,
+                      digest: str):
+        if not fingerprint:
+            return
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?, ?)",
+                (serial, fingerprint, target, digest, time.time()))
+            db.commit()
+
+    def forget(self, serial: str, target: str = None):
+        """ drop records of device, or only one target of it """
+        with self._lock:
+            db = self._db()
+            if target:
+                db.execute("DELETE FROM verified WHERE serial=? AND target=?",
+                           (serial, target))
+            else:
+                db.execute("DELETE FROM verified WHERE serial=?", (serial, ))
+            db.commit()
+
+    def get_state(self, serial: str, key: str):
+        with self._lock:
+            row = self._db().execute(
+                "SELECT value FROM state WHERE serial=? AND key=?",
+                (serial, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_state(self, serial: str, key: str, value):
+        with self._lock:
+            db = self._db()
+            db.execute("INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)",
+                       (serial, key, json.dumps(value), time.time()))
+            db.commit()
+
+    def states(self) -> list:
+        """ Returns: list of (serial, key, value) of all devices """
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT serial, key, value FROM state").fetchall()
+        return [(serial, key, json.loads(value))
+                for serial, key, value in rows]
+
+    def drop_state(self, serial: str, key: str):
+        with self._lock:
+            db = self._db()
+            db.execute("DELETE FROM state WHERE serial=? AND key=?",
+                       (serial, key))
+            db.commit()
+
+    def cached_apks(self, serial: str) -> list:
+        """ Returns: list of (digest, size, used), least recently used first """
+        with self._lock:
+            return self._db().execute(
+                "SELECT digest, size, used FROM apk_cache WHERE serial=? "
+                "ORDER BY used", (serial, )).fetchall()
+
+    def touch_apk(self, serial: str, digest: str, size: int):
+        with self._lock:
+            db = self._db()
+            db.execute("INSERT OR REPLACE INTO apk_cache VALUES (?, ?, ?, ?)",
+                       (serial, digest, size, time.time()))
+            db.commit()
+
+    def drop_apk(self, serial: str, digest: str):
+        with self._lock:
+            db = self._db()
+            db.execute("DELETE FROM apk_cache WHERE serial=? AND digest=?",
+                       (serial, digest))
+            db.commit()
+
+
+devicestore = DeviceStore()
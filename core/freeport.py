@@ -5,9 +5,13 @@ import socket
 
 
 class FreePort(object):
-    def __init__(self):
-        self._start = 20000
-        self._end = 40000
+    def __init__(self, start: int = 20000, end: int = 40000):
+        self.set_range(start, end)
+
+    def set_range(self, start: int, end: int):
+        """ ports are taken from start to end (included) """
+        self._start = start
+        self._end = end
         self._now = self._start-1
 
     def get(self):
@@ -0,0 +1,175 @@
+# coding: utf-8
+#
+# Push files gzip compressed and decompress them on the device.
+#
+# Over a USB 2.0 link or a busy hub the link is the bottleneck, sending fewer
+# bytes wins even though the device has to run gzip -d (toybox) afterwards.
+# Whether to compress is decided per file: a few samples are compressed to
+# estimate the ratio, then the transfer time saved is compared with the
+# decompress time, using the push speed measured on earlier pushes of the
+# same device.
+
+import gzip
+import threading
+import time
+import zlib
+
+from logzero import logger
+
+import settings
+
+MODE_NEVER = "never"
+MODE_AUTO = "auto"
+MODE_ALWAYS = "always"
+
+LEVEL = 1  # higher levels are slower than a usb 2.0 link on one core
+MIN_SIZE = 1 << 20  # smaller files are not worth a gzip -d round trip
+SAMPLES = 4
+SAMPLE_SIZE = 64 * 1024
+DEFAULT_LINK_SPEED = 20 << 20  # bytes/s, usb 2.0 in practice
+DECOMPRESS_SPEED = 60 << 20  # bytes/s of output, gzip -d on a mid range phone
+
+_PROBE = gzip.compress(b"atx\n", mtime=0)
+
+
+class GzipReader(object):
+    """ file wrapper which returns gzip compressed data """
+
+    def __init__(self, fileobj, level: int = LEVEL):
+        self._fileobj = fileobj
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        self._buffer = bytearray()
+        self._eof = False
+
+    def read(self, size=-1):
+        while (size < 0 or len(self._buffer) < size) and not self._eof:
+            data = self._fileobj.read(SAMPLE_SIZE)
+            if data:
+                self._buffer += self._compressor.compress(data)
+            else:
+                self._buffer += self._compressor.flush()
+                self._eof = True
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def estimate(f, size: int) -> tuple:
+    """
+    compress a few samples spread over the file
+
+    Args:
+        f: seekable file object, rewinded before return
+
+    Returns:
+        (compressed size / original size, compress speed in bytes/s)
+    """
+    sampled = compressed = 0
+    cpu_time = 0.0
+    for i in range(SAMPLES):
+        f.seek(size * i // SAMPLES)
+        data = f.read(SAMPLE_SIZE)
+        start = time.perf_counter()
+        compressed += len(zlib.compress(data, LEVEL))
+        cpu_time += time.perf_counter() - start
+        sampled += len(data)
+    f.seek(0)
+    if not sampled:
+        return 1.0, float("inf")
+    return compressed / sampled, sampled / max(cpu_time, 1e-6)
+
+
+class GzipPusher(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._supported = {}  # serial -> bool
+        self._speeds = {}  # serial -> bytes/s of the link
+
+    def push(self, device, f, dst: str, mode: int = 0o755, size: int = None,
+             wrap=None) -> bool:
+        """
+        push like device.sync.push, compressed when it is faster
+
+        Args:
+            device: adbutils device
+            f: seekable file object
+            size: file size, required when compression is enabled
+            wrap: func(fileobj) -> fileobj applied to the uncompressed data,
+                e.g. to report progress
+
+        Returns:
+            whether the file was sent compressed
+        """
+        wrap = wrap or (lambda fileobj: fileobj)
+        if self._should_compress(device, f, size):
+            start = time.time()
+            tmp = dst + ".gz"
+            sent = device.sync.push(GzipReader(wrap(f)), tmp, mode)
+            self._record(device.serial, sent, time.time() - start)
+            output = device.shell("gzip -d -f %s && chmod %o %s && echo OK" %
+                                  (tmp, mode, dst))
+            if output.strip().endswith("OK"):
+                logger.debug("[%s] gzip push %s %d -> %d bytes in %.1fs",
+                             device.serial, dst, size, sent,
+                             time.time() - start)
+                return True
+            logger.warning("[%s] gzip -d %s failed: %s, push plain",
+                           device.serial, tmp, output.strip())
+            device.shell(["rm", "-f", tmp])
+            with self._lock:
+                self._supported[device.serial] = False
+            f.seek(0)
+
+        start = time.time()
+        sent = device.sync.push(wrap(f), dst, mode)
+        self._record(device.serial, sent, time.time() - start)
+        return False
+
+    def _should_compress(self, device, f, size: int) -> bool:
+        if settings.push_compress == MODE_NEVER or not size:
+            return False
+        if settings.push_compress == MODE_AUTO and size < MIN_SIZE:
+            return False
+        if not self._gzip_supported(device):
+            return False
+        if settings.push_compress == MODE_ALWAYS:
+            return True
+        ratio, compress_speed = estimate(f, size)
+        link_speed = self._speeds.get(device.serial, DEFAULT_LINK_SPEED)
+        plain = size / link_speed
+        # compressing overlaps with sending, decompressing comes after
+        compressed = max(size / compress_speed, size * ratio / link_speed
+                         ) + size / DECOMPRESS_SPEED
+        logger.debug("[%s] compress ratio %.2f, link %.1f MB/s, "
+                     "plain %.2fs, gzip %.2fs", device.serial, ratio,
+                     link_speed / 2**20, plain, compressed)
+        return compressed < plain
+
+    def _gzip_supported(self, device) -> bool:
+        """ toybox has gzip since Android 9, some vendors ship busybox """
+        with self._lock:
+            supported = self._supported.get(device.serial)
+        if supported is None:
+            probe = "/data/local/tmp/.gzprobe.gz"
+            device.sync.push(_PROBE, probe, 0o644)
+            output = device.shell("gzip -dc %s; rm -f %s" % (probe, probe))
+            supported = output.strip() == "atx"
+            logger.debug("[%s] gzip supported: %s", device.serial, supported)
+            with self._lock:
+                self._supported[device.serial] = supported
+        return supported
+
+    def _record(self, serial: str, nbytes: int, seconds: float):
+        """ moving average of link speed, bytes on the wire per second """
+        if nbytes < MIN_SIZE or seconds <= 0:
+            return
+        speed = nbytes / seconds
+        with self._lock:
+            last = self._speeds.get(serial)
+            self._speeds[serial] = speed if last is None else (last * .7 +
+                                                               speed * .3)
+
+
+gzpush = GzipPusher()
@@ -0,0 +1,83 @@
+# coding: utf-8
+#
+# Long running jobs (eg. apk install) with progress which can be watched by
+# several subscribers.
+
+import time
+
+from tornado.ioloop import IOLoop
+
+from core.utils import id_generator
+
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_SUCCESS = "success"
+STATUS_FAILED = "failed"
+
+
+class Job(object):
+    def __init__(self, job_id: str, **info):
+        self.id = job_id
+        self.state = dict(info, id=job_id, status=STATUS_PENDING)
+        self.created = time.time()
+        self._ioloop = IOLoop.current()
+        self._subscribers = set()
+        self._last_emit = 0
+
+    @property
+    def done(self) -> bool:
+        return self.state['status'] in (STATUS_SUCCESS, STATUS_FAILED)
+
+    def update(self, throttle: bool = False, **kwargs):
+        """
+        update state and notify subscribers, safe to call from any thread
+
+        Args:
+            throttle: skip notify if last one was less than 0.2s ago,
+                used for frequent updates like transfered bytes
+        """
+        self._ioloop.add_callback(self._update, throttle, kwargs)
+
+    def _update(self, throttle: bool, kwargs: dict):
+        self.state.update(kwargs)
+        now = time.time()
+        if throttle and now - self._last_emit < .2:
+            return
+        self._last_emit = now
+        for callback in list(self._subscribers):
+            callback(dict(self.state))
+
+    def subscribe(self, callback):
+        """ callback(state: dict) is called in IOLoop thread """
+        self._subscribers.add(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.discard(callback)
+
+
+class JobRegistry(object):
+    def __init__(self, ttl: float = 3600):
+        """
+        Args:
+            ttl: seconds to keep finished jobs
+        """
+        self._ttl = ttl
+        self._jobs = {}
+
+    def create(self, **info) -> Job:
+        self._expire()
+        job = Job(id_generator(16), **info)
+        self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Job:
+        return self._jobs.get(job_id)
+
+    def _expire(self):
+        deadline = time.time() - self._ttl
+        for job_id, job in list(self._jobs.items()):
+            if job.done and job.created < deadline:
+                del self._jobs[job_id]
+
+
+jobs = JobRegistry()
@@ -0,0 +1,123 @@
+# coding: utf-8
+#
+# Load of this provider, advertised as heartbeat priority.
+#
+# The server routes sessions to providers with higher priority. Instead of a
+# fixed number set by hand, the priority goes down as the provider gets busy:
+# cpu, connections through the port relays, queued device jobs and pushes
+# waiting for a usb hub.
+
+import os
+
+from logzero import logger
+from tornado import gen
+
+from core.transfer import scheduler
+from core.workqueue import workqueue
+
+MAX_PRIORITY = 10  # idle provider
+RELAY_CAPACITY = 256  # relay connections of a fully loaded provider
+
+WEIGHTS = {
+    "cpu": .4,
+    "relays": .2,
+    "jobs": .25,
+    "usb": .15,
+}
+
+
+def cpu_load() -> float:
+    """ 1 minute load average per cpu, 0 where it is not available """
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):  # windows
+        return 0.0
+
+
+def established(ports: set) -> int:
+    """ number of established tcp connections accepted on ports """
+    if not ports:
+        return 0
+    count = 0
+    for path in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(path) as f:
+                next(f)  # header
+                for line in f:
+                    fields = line.split()
+                    local, state = fields[1], fields[3]
+                    if state == "01" and int(local.rsplit(":", 1)[1],
+                                             16) in ports:
+                        count += 1
+        except OSError:  # not linux
+            pass
+    return count
+
+
+def collect(ports: set) -> dict:
+    """
+    Args:
+        ports: listening ports of relays
+    """
+    jobs = workqueue.stats()
+    usb = scheduler.stats()
+    return {
+        "cpu": cpu_load(),
+        "relays": established(ports),
+        "jobs": jobs['running'] + jobs['pending'],
+        "jobBudget": workqueue.budget or 4,
+        "usbWaiting": usb['waiting'],
+        "usbSlots": usb['slots'],
+    }
+
+
+def merge(stats: list) -> dict:
+    """ sum stats of several worker processes """
+    merged = {}
+    for s in stats:
+        for k, v in s.items():
+            merged[k] = max(merged.get(k, 0), v) if k == "cpu" else (
+                merged.get(k, 0) + v)
+    return merged
+
+
+def score(stats: dict) -> float:
+    """ 0 (idle) to 1 (saturated) """
+    parts = {
+        "cpu": stats.get("cpu", 0),
+        "relays": stats.get("relays", 0) / RELAY_CAPACITY,
+        "jobs": stats.get("jobs", 0) / (2 * stats.get("jobBudget", 4)),
+        "usb": stats.get("usbWaiting", 0) / (stats.get("usbSlots") or 1),
+    }
+    return sum(WEIGHTS[k] * min(1.0, v) for k, v in parts.items())
+
+
+def to_priority(load: float) -> int:
+    """ the larger the importanter, 1 when saturated """
+    return 1 + int(round((MAX_PRIORITY - 1) * (1 - load)))
+
+
+def report(stats: dict) -> dict:
+    load = score(stats)
+    return {"stats": stats, "score": load, "priority": to_priority(load)}
+
+
+async def advertise(hbconn, get_stats, interval: float = 10.0):
+    """
+    update heartbeat priority when the load changes
+
+    Args:
+        get_stats: coroutine function returning stats of collect()
+    """
+    while True:
+        await gen.sleep(interval)
+        try:
+            stats = await get_stats()
+        except Exception as e:
+            logger.warning("collect load stats error: %s", e)
+            continue
+        priority = to_priority(score(stats))
+        if priority != hbconn.priority:
+            logger.info("Load %s, priority %d -> %d", stats, hbconn.priority,
+                        priority)
+            await hbconn.set_priority(priority)
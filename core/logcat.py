@@ -0,0 +1,219 @@
+# coding: utf-8
+#
+# One logcat reader per device, shared by all subscribers.
+#
+# Lines are parsed once and kept in a ring buffer of fixed size. A subscriber
+# is only a cursor into that buffer with its own filters, it sends what it
+# has not sent yet whenever its previous write finished. A subscriber too
+# slow to keep up skips the lines which already fell out of the buffer, so
+# memory per device does not grow with the number or speed of subscribers.
+# The reader stops (and the buffer is dropped) when nobody subscribed for
+# LINGER seconds, so idle devices do not stream logcat over usb.
+
+import collections
+import itertools
+import re
+
+from logzero import logger
+from tornado import gen, websocket
+from tornado.ioloop import IOLoop
+
+LEVELS = "VDIWEF"
+LINGER = 30.0  # seconds reader is kept after the last subscriber left
+BATCH = 500  # max lines in one websocket message
+
+# threadtime: 03-13 10:20:30.123  1234  1256 I ActivityManager: message
+_LINE = re.compile(
+    r"^\d\d-\d\d \d\d:\d\d:\d\d\.\d+\s+(\d+)\s+\d+\s+([VDIWEFS])\s+(.*?)\s*: ")
+
+Entry = collections.namedtuple("Entry", ["seq", "line", "level", "tag", "pid"])
+
+
+class LogFilter(object):
+    def __init__(self, level: str = None, tag: str = None, pid: int = None,
+                 grep: str = None):
+        """
+        Args:
+            level: minimum level, one of VDIWEF
+            tag: regex matched against the whole tag
+            grep: regex searched in the whole line
+        """
+        self._level = LEVELS.index(level.upper()) if level else 0
+        self._tag = re.compile(tag) if tag else None
+        self._pid = pid
+        self._grep = re.compile(grep) if grep else None
+
+    def match(self, e: Entry) -> bool:
+        if e.level is None:  # lines like "--------- beginning of main"
+            return not (self._level or self._tag or self._pid or self._grep)
+        if LEVELS.find(e.level) < self._level:
+            return False
+        if self._tag and not self._tag.fullmatch(e.tag):
+            return False
+        if self._pid and e.pid != self._pid:
+            return False
+        if self._grep and not self._grep.search(e.line):
+            return False
+        return True
+
+
+class LogcatSubscriber(object):
+    def __init__(self, handler: websocket.WebSocketHandler,
+                 filters: LogFilter, tail: int = 100):
+        """
+        Args:
+            tail: lines of buffer sent first (before filtering)
+        """
+        self._handler = handler
+        self._filters = filters
+        self._tail = tail
+        self._stream = None
+        self._cursor = None  # seq of last line sent
+        self._sending = False
+
+    def attach(self, stream):
+        self._stream = stream
+        self._cursor = max(stream.first_seq - 1, stream.last_seq - self._tail)
+        self.notify()
+
+    def notify(self):
+        if not self._sending and self._stream:
+            self._sending = True
+            IOLoop.current().spawn_callback(self._flush)
+
+    async def _flush(self):
+        try:
+            while self._cursor < self._stream.last_seq:
+                skipped, entries = self._stream.since(self._cursor, BATCH)
+                lines = []
+                if skipped:
+                    lines.append("--------- skipped %d lines" % skipped)
+                lines.extend(e.line for e in entries if self._filters.match(e))
+                self._cursor = entries[-1].seq if entries else \
+                    self._stream.last_seq
+                if lines:
+                    await self._handler.write_message("\n".join(lines))
+        except websocket.WebSocketClosedError:
+            self._stream = None
+        finally:
+            self._sending = False
+
+
+class LogcatStream(object):
+    def __init__(self, adb, serial: str, size: int):
+        """
+        Args:
+            adb: asyncadb.AdbClient the device connected to
+            size: lines kept in ring buffer
+        """
+        self._adb = adb
+        self._serial = serial
+        self._buffer = collections.deque(maxlen=size)
+        self._seq = 0
+        self._subscribers = set()
+        self._task = None  # Future of _run
+        self._linger = None
+        self._stopped = False
+
+    @property
+    def first_seq(self) -> int:
+        return self._buffer[0].seq if self._buffer else self._seq + 1
+
+    @property
+    def last_seq(self) -> int:
+        return self._seq
+
+    def since(self, cursor: int, limit: int):
+        """
+        Returns:
+            (lines already dropped from buffer, list of Entry after cursor)
+        """
+        first = self.first_seq
+        skipped = max(0, first - cursor - 1)
+        start = max(cursor + 1, first) - first
+        return skipped, list(
+            itertools.islice(self._buffer, start, start + limit))
+
+    def subscribe(self, sub: LogcatSubscriber):
+        if self._linger:
+            IOLoop.current().remove_timeout(self._linger)
+            self._linger = None
+        self._subscribers.add(sub)
+        sub.attach(self)
+        if self._task is None and not self._stopped:
+            self._task = gen.convert_yielded(self._run())
+
+    def unsubscribe(self, sub: LogcatSubscriber):
+        self._subscribers.discard(sub)
+        if not self._subscribers and not self._linger:
+            self._linger = IOLoop.current().call_later(LINGER, self._idle)
+
+    def _idle(self):
+        self._linger = None
+        if self._subscribers or self._task is None:
+            return
+        logger.debug("[%s] no logcat subscriber, stop reading", self._serial)
+        self._task.cancel()  # closes the adb connection
+        self._task = None
+        # the device keeps its own log, read from start when subscribed again
+        self._buffer.clear()
+
+    async def _run(self):
+        command = "logcat -v threadtime"
+        while not self._stopped:
+            try:
+                async for line in self._adb.shell_stream(self._serial,
+                                                         command,
+                                                         lines=True):
+                    self._append(line)
+                    if self._stopped:
+                        break
+            except Exception as e:
+                logger.warning("[%s] logcat error: %s", self._serial, e)
+            if self._stopped:
+                break
+            # started again, skip lines before the last one already seen
+            command = "logcat -v threadtime -T 1"
+            await gen.sleep(1)
+
+    def _append(self, line: str):
+        self._seq += 1
+        m = _LINE.match(line)
+        if m:
+            entry = Entry(self._seq, line, m.group(2), m.group(3),
+                          int(m.group(1)))
+        else:
+            entry = Entry(self._seq, line, None, None, None)
+        self._buffer.append(entry)
+        for sub in self._subscribers:
+            sub.notify()
+
+    def stop(self):
+        self._stopped = True
+        if self._linger:
+            IOLoop.current().remove_timeout(self._linger)
+            self._linger = None
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+class LogcatHub(object):
+    def __init__(self, size: int = 10000):
+        self.size = size
+        self._streams = {}  # udid -> LogcatStream
+
+    def stream(self, udid: str, adb, serial: str) -> LogcatStream:
+        s = self._streams.get(udid)
+        if s is None:
+            s = self._streams[udid] = LogcatStream(adb, serial, self.size)
+        return s
+
+    def forget(self, udid: str):
+        """ device is gone """
+        s = self._streams.pop(udid, None)
+        if s:
+            s.stop()
+
+
+logcats = LogcatHub()
@@ -0,0 +1,170 @@
+# coding: utf-8
+#
+# Watchdog of the tornado IOLoop.
+#
+# A callback scheduled every <interval> measures how late it runs, that is
+# the loop lag. A thread checks the last tick of that callback, when the loop
+# has not ticked for <threshold> seconds, something is blocking it and the
+# stack of the loop thread is captured. Stacks are grouped by the innermost
+# frame in this project, so hidden synchronous calls (adb pushes, apk
+# parsing, subprocess) show up with the code which made them.
+
+import os
+import sys
+import threading
+import time
+import traceback
+
+from logzero import logger
+from tornado.ioloop import IOLoop
+
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+_project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _site(stack: traceback.StackSummary) -> str:
+    """ innermost frame of project code, e.g. main.py:120 in app_install """
+    for frame in reversed(stack):
+        path = os.path.abspath(frame.filename)
+        if path.startswith(_project_dir) and "site-packages" not in path:
+            return "%s:%d in %s" % (os.path.relpath(path, _project_dir),
+                                    frame.lineno, frame.name)
+    frame = stack[-1]
+    return "%s:%d in %s" % (frame.filename, frame.lineno, frame.name)
+
+
+class LoopMonitor(object):
+    def __init__(self, interval: float = .05, threshold: float = .2,
+                 max_sites: int = 50):
+        """
+        Args:
+            interval: seconds between lag samples
+            threshold: seconds of blocking before the stack is captured,
+                0 disables the watchdog thread
+            max_sites: blocking sites kept, the least blocking are dropped
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.max_sites = max_sites
+        self._lock = threading.Lock()
+        self._histogram = [0] * (len(BUCKETS_MS) + 1)
+        self._samples = 0
+        self._max_lag = 0.0
+        self._sites = {}  # site -> dict
+        self._last_tick = None
+        self._expected = None
+        self._thread_id = None
+
+    def start(self):
+        """ start monitoring the current IOLoop """
+        self._thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._expected = self._last_tick + self.interval
+        IOLoop.current().call_later(self.interval, self._tick)
+        if self.threshold:
+            th = threading.Thread(target=self._watch,
+                                  name="loop-watchdog",
+                                  daemon=True)
+            th.start()
+
+    def _tick(self):
+        now = time.monotonic()
+        lag = max(0.0, now - self._expected)
+        index = len(BUCKETS_MS)
+        for i, bound in enumerate(BUCKETS_MS):
+            if lag * 1000 <= bound:
+                index = i
+                break
+        with self._lock:
+            self._histogram[index] += 1
+            self._samples += 1
+            self._max_lag = max(self._max_lag, lag)
+            self._last_tick = now
+        self._expected = now + self.interval
+        IOLoop.current().call_later(self.interval, self._tick)
+
+    def _watch(self):
+        stall = None  # (tick, site, seconds already accounted)
+        while True:
+            time.sleep(min(self.interval, self.threshold / 2))
+            with self._lock:
+                last_tick = self._last_tick
+            blocked = time.monotonic() - last_tick
+            if blocked < self.threshold:
+                stall = None
+                continue
+            if stall and stall[0] == last_tick:  # still the same stall
+                self._account(stall[1], blocked - stall[2], blocked)
+                stall = (last_tick, stall[1], blocked)
+                continue
+
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            site = _site(stack)
+            logger.warning("IOLoop blocked for %.0fms at %s", blocked * 1000,
+                           site)
+            with self._lock:
+                info = self._sites.get(site)
+                if info is None:
+                    self._trim()
+                    info = self._sites[site] = {
+                        "site": site,
+                        "count": 0,
+                        "total_ms": 0.0,
+                        "max_ms": 0.0,
+                    }
+                info['count'] += 1
+                info['last'] = time.time()
+                info['stack'] = traceback.format_list(stack[-15:])
+            self._account(site, blocked, blocked)
+            stall = (last_tick, site, blocked)
+
+    def _account(self, site: str, seconds: float, blocked: float):
+        with self._lock:
+            info = self._sites.get(site)
+            if info:
+                info['total_ms'] += seconds * 1000
+                info['max_ms'] = max(info['max_ms'], blocked * 1000)
+
+    def _trim(self):
+        """ make room for a new site """
+        while self._sites and len(self._sites) >= self.max_sites:
+            site = min(self._sites, key=lambda k: self._sites[k]['total_ms'])
+            del self._sites[site]
+
+    def _percentile(self, pct: float):
+        """ upper bound of the histogram bucket, None if above all """
+        rank = pct / 100.0 * self._samples
+        count = 0
+        for i, n in enumerate(self._histogram):
+            count += n
+            if count >= rank and n:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else None
+        return 0
+
+    def report(self) -> dict:
+        with self._lock:
+            histogram = [{
+                "le_ms": BUCKETS_MS[i] if i < len(BUCKETS_MS) else None,
+                "count": n,
+            } for i, n in enumerate(self._histogram)]
+            return {
+                "interval": self.interval,
+                "threshold": self.threshold,
+                "lag": {
+                    "samples": self._samples,
+                    "max_ms": self._max_lag * 1000,
+                    "p50_ms": self._percentile(50),
+                    "p99_ms": self._percentile(99),
+                    "histogram": histogram,
+                },
+                "blocking": sorted([dict(v) for v in self._sites.values()],
+                                   key=lambda v: v['total_ms'],
+                                   reverse=True),
+            }
+
+
+loopmonitor = LoopMonitor()
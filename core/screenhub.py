@@ -0,0 +1,167 @@
+# coding: utf-8
+#
+# Share one screen stream of a device between all viewers.
+#
+# Each device has at most one upstream websocket (minicap of atx-agent, or
+# the worker process in multi-process mode), frames are fanned out to every
+# subscriber. A subscriber only keeps the newest frame while its previous
+# write is still in flight, so a slow viewer skips frames instead of slowing
+# down the upstream and the other viewers.
+
+from logzero import logger
+from tornado import gen, websocket
+from tornado.ioloop import IOLoop
+
+LINGER = 5.0  # seconds upstream is kept after the last viewer left
+RETRIES = 3  # upstream connect failures before giving up
+
+
+class Subscriber(object):
+    def __init__(self, handler: websocket.WebSocketHandler):
+        self._handler = handler
+        self._texts = []  # text messages (e.g. rotation) are never dropped
+        self._frame = None
+        self._sending = False
+        self.sent = 0
+        self.dropped = 0
+
+    def offer(self, message):
+        if isinstance(message, str):
+            self._texts.append(message)
+        else:
+            if self._frame is not None:
+                self.dropped += 1
+            self._frame = message
+        if not self._sending:
+            self._sending = True
+            IOLoop.current().spawn_callback(self._flush)
+
+    async def _flush(self):
+        try:
+            while self._texts or self._frame is not None:
+                if self._texts:
+                    message = self._texts.pop(0)
+                else:
+                    message, self._frame = self._frame, None
+                await self._handler.write_message(
+                    message, binary=isinstance(message, bytes))
+                self.sent += 1
+        except websocket.WebSocketClosedError:
+            self._texts, self._frame = [], None
+        finally:
+            self._sending = False
+
+    def close(self):
+        self._handler.close()
+
+
+class ScreenStream(object):
+    def __init__(self, key: str, url: str, on_idle):
+        self._key = key
+        self._url = url
+        self._on_idle = on_idle
+        self._subscribers = set()
+        self._last_frame = None
+        self._last_text = None
+        self._conn = None
+        self._running = False
+        self._linger = None
+
+    def subscribe(self, sub: Subscriber):
+        if self._linger:
+            IOLoop.current().remove_timeout(self._linger)
+            self._linger = None
+        self._subscribers.add(sub)
+        for message in (self._last_text, self._last_frame):
+            if message is not None:  # show something at once
+                sub.offer(message)
+        if not self._running:
+            self._running = True
+            IOLoop.current().spawn_callback(self._run)
+
+    def unsubscribe(self, sub: Subscriber):
+        self._subscribers.discard(sub)
+        logger.debug("%s viewer left, sent %d, dropped %d", self._key,
+                     sub.sent, sub.dropped)
+        if not self._subscribers and not self._linger:
+            self._linger = IOLoop.current().call_later(LINGER, self.close)
+
+    @property
+    def last_frame(self):
+        return self._last_frame
+
+    @property
+    def viewers(self) -> int:
+        return len(self._subscribers)
+
+    def _abandoned(self) -> bool:
+        """ linger close already happened, e.g. while still connecting """
+        return not self._subscribers and not self._linger
+
+    async def _run(self):
+        failures = 0
+        while self._subscribers and failures < RETRIES:
+            try:
+                self._conn = await websocket.websocket_connect(self._url)
+            except Exception as e:
+                failures += 1
+                logger.warning("%s screen upstream %s: %s", self._key,
+                               self._url, e)
+                await gen.sleep(1)
+                continue
+            failures = 0
+            logger.info("%s screen upstream connected", self._key)
+            while not self._abandoned():
+                message = await self._conn.read_message()
+                if message is None:
+                    break
+                if isinstance(message, str):
+                    self._last_text = message
+                else:
+                    self._last_frame = message
+                for sub in list(self._subscribers):
+                    sub.offer(message)
+            self._conn.close()
+            self._conn = None
+            self._last_frame = None
+        self._running = False
+        for sub in list(self._subscribers):  # upstream is gone
+            sub.close()
+        self.close()
+
+    def close(self):
+        self._linger = None
+        if self._conn:
+            self._conn.close()
+        self._on_idle(self._key, self)
+
+
+class ScreenHub(object):
+    def __init__(self):
+        self._streams = {}  # key -> ScreenStream
+
+    def stream(self, key: str, url: str) -> ScreenStream:
+        """
+        Args:
+            key: udid
+            url: websocket url of upstream, used when not connected yet
+        """
+        s = self._streams.get(key)
+        if s is None:
+            s = self._streams[key] = ScreenStream(key, url, self._remove)
+        return s
+
+    def last_frame(self, key: str):
+        """ newest frame of a connected stream, None if nobody watches """
+        s = self._streams.get(key)
+        return s.last_frame if s else None
+
+    def _remove(self, key: str, stream: ScreenStream):
+        if self._streams.get(key) is stream and not stream.viewers:
+            del self._streams[key]
+
+    def stats(self) -> dict:
+        return {key: s.viewers for key, s in self._streams.items()}
+
+
+screenhub = ScreenHub()
@@ -0,0 +1,112 @@
+# coding: utf-8
+#
+# Small screenshots for dashboards which show a grid of devices.
+#
+# Every device watched by someone has one background task which captures a
+# screenshot every <interval> seconds and keeps a downscaled JPEG, requests
+# are answered from that cache. The task stops when nobody asked for the
+# thumbnail for a while, so unwatched devices are not touched. The ETag only
+# changes when the thumbnail does.
+
+import hashlib
+import io
+import time
+
+from logzero import logger
+from PIL import Image
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+
+class Thumbnail(object):
+    def __init__(self, data: bytes, updated: float):
+        self.data = data
+        self.updated = updated
+        self.etag = hashlib.md5(data).hexdigest()
+
+
+def downscale(data: bytes, size: int, quality: int) -> bytes:
+    """ jpeg/png bytes to jpeg fits into size x size """
+    im = Image.open(io.BytesIO(data))
+    im.thumbnail((size, size))
+    buf = io.BytesIO()
+    im.convert("RGB").save(buf, "JPEG", quality=quality)
+    return buf.getvalue()
+
+
+class _Entry(object):
+    def __init__(self):
+        self.thumbnail = None
+        self.ready = None  # Future resolved after first capture
+        self.last_access = time.time()
+        self.running = False
+
+
+class ThumbnailCache(object):
+    def __init__(self, interval: float = 10.0, size: int = 240,
+                 quality: int = 60, idle: float = 60.0):
+        """
+        Args:
+            interval: seconds between captures of one device
+            size: max width and height of thumbnail
+            idle: seconds without request before capture stops
+        """
+        self.interval = interval
+        self.size = size
+        self.quality = quality
+        self.idle = idle
+        self._entries = {}  # udid -> _Entry
+
+    async def get(self, udid: str, capture, timeout: float = 10.0):
+        """
+        Args:
+            capture: coroutine function returning screenshot bytes
+
+        Returns:
+            Thumbnail or None if first capture failed
+        """
+        entry = self._entries.get(udid)
+        if entry is None:
+            entry = self._entries[udid] = _Entry()
+        entry.last_access = time.time()
+        if not entry.running:
+            entry.running = True
+            entry.ready = Future()
+            IOLoop.current().spawn_callback(self._run, udid, entry, capture)
+        if entry.thumbnail is None:
+            try:
+                await gen.with_timeout(IOLoop.current().time() + timeout,
+                                       entry.ready)
+            except gen.TimeoutError:
+                pass
+        return entry.thumbnail
+
+    async def _run(self, udid: str, entry: _Entry, capture):
+        first = entry.ready  # resolved after the first capture
+        try:
+            while self._entries.get(udid) is entry and \
+                    time.time() - entry.last_access < self.idle:
+                try:
+                    data = await capture()
+                    data = await IOLoop.current().run_in_executor(
+                        None, downscale, data, self.size, self.quality)
+                    if entry.thumbnail is None or data != entry.thumbnail.data:
+                        entry.thumbnail = Thumbnail(data, time.time())
+                except Exception as e:
+                    logger.warning("[%s] capture thumbnail error: %s", udid, e)
+                if not first.done():
+                    first.set_result(None)
+                await gen.sleep(self.interval)
+        finally:
+            entry.running = False
+            if not first.done():
+                first.set_result(None)
+        logger.debug("[%s] thumbnail idle, stop capture", udid)
+
+    def forget(self, udid: str):
+        """ device is gone, capture task stops after current round """
+        self._entries.pop(udid, None)
+
+
+thumbnails = ThumbnailCache()
@@ -0,0 +1,109 @@
+# coding: utf-8
+#
+# Limit concurrent bulk transfers (push, install) per USB hub.
+#
+# Devices behind one hub share its bandwidth, running too many pushes at the
+# same time makes all of them slow. Waiters are served round-robin by device,
+# so a device with lots of files does not starve others on the same hub.
+
+import collections
+import contextlib
+import threading
+
+from logzero import logger
+
+
+def usb_hub(usb_path: str):
+    """
+    Args:
+        usb_path: eg 1-1.4.2 (bus 1, root port 1, then port 4, port 2)
+
+    Returns:
+        path of the hub which the device is plugged into, eg 1-1.4
+    """
+    if not usb_path:
+        return None
+    if "." in usb_path:
+        return usb_path.rsplit(".", 1)[0]
+    return usb_path.split("-", 1)[0]  # root hub of the bus
+
+
+class _Hub(object):
+    def __init__(self):
+        self.active = 0
+        self.waiters = collections.OrderedDict()  # serial -> deque of Event
+
+
+class TransferScheduler(object):
+    def __init__(self, limit: int = 2):
+        """
+        Args:
+            limit: max concurrent transfers of each hub, 0 means no limit
+        """
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._hubs = collections.defaultdict(_Hub)
+        self._serial2hub = {}
+
+    def register(self, serial: str, origin: str = None, usb_path: str = None):
+        """ record which hub the device is plugged into """
+        hub = usb_hub(usb_path)
+        with self._lock:
+            if hub:
+                self._serial2hub[serial] = "%s/%s" % (origin or "", hub)
+            else:
+                self._serial2hub.pop(serial, None)
+
+    def _acquire(self, serial: str):
+        with self._lock:
+            key = self._serial2hub.get(serial)
+            if key is None or not self.limit:
+                return None
+            hub = self._hubs[key]
+            if hub.active < self.limit and not hub.waiters:
+                hub.active += 1
+                return hub
+            event = threading.Event()
+            hub.waiters.setdefault(serial, collections.deque()).append(event)
+        logger.debug("[%s] wait transfer slot of hub %s", serial, key)
+        event.wait()
+        return hub  # slot handed over by _release
+
+    def _release(self, hub: _Hub):
+        with self._lock:
+            if not hub.waiters:
+                hub.active -= 1
+                return
+            serial, events = hub.waiters.popitem(last=False)
+            event = events.popleft()
+            if events:  # round-robin, put device at the end
+                hub.waiters[serial] = events
+            event.set()
+
+    def stats(self) -> dict:
+        """ slots of hubs with devices, and transfers waiting for them """
+        with self._lock:
+            hubs = set(self._serial2hub.values())
+            return {
+                "slots": self.limit * len(hubs),
+                "waiting": sum(
+                    len(events) for hub in self._hubs.values()
+                    for events in hub.waiters.values()),
+            }
+
+    @contextlib.contextmanager
+    def slot(self, serial: str):
+        """
+        Example:
+            with scheduler.slot(serial):
+                device.sync.push(...)
+        """
+        hub = self._acquire(serial)
+        try:
+            yield
+        finally:
+            if hub:
+                self._release(hub)
+
+
+scheduler = TransferScheduler()
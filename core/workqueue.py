@@ -0,0 +1,117 @@
+# coding: utf-8
+#
+# Per-device work queue with priorities.
+#
+# - jobs of one device run one at a time
+# - at most <budget> jobs run at the same time across all devices
+# - pending jobs start by priority, then by arrival
+# - background jobs call checkpoint() between steps, it raises Preempted
+#   when a more important job is waiting, the job is then queued again
+
+import itertools
+
+from logzero import logger
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+PRIORITY_INTERACTIVE = 0  # user actions, eg /app/install
+PRIORITY_COLD = 1  # device reset after use
+PRIORITY_BACKGROUND = 2  # device init, maintenance
+
+
+class Preempted(Exception):
+    """ background job gives way to a more important job """
+
+
+class _Job(object):
+    def __init__(self, serial: str, priority: int, seq: int, func, args,
+                 kwargs):
+        self.serial = serial
+        self.priority = priority
+        self.seq = seq
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+
+    @property
+    def order(self):
+        return (self.priority, self.seq)
+
+
+class WorkQueue(object):
+    def __init__(self, budget: int = 4):
+        """
+        Args:
+            budget: max jobs running at the same time, 0 means no limit
+        """
+        self.budget = budget
+        self._pending = []  # list of _Job
+        self._running = {}  # serial -> _Job
+        self._seq = itertools.count()
+
+    async def run(self, serial: str, priority: int, func, *args, **kwargs):
+        """
+        queue func(*args, **kwargs) and wait for its result
+
+        Args:
+            func: coroutine function or function returning a Future
+        """
+        job = _Job(serial, priority, next(self._seq), func, args, kwargs)
+        self._pending.append(job)
+        self._schedule()
+        return await job.future
+
+    def _full(self) -> bool:
+        return bool(self.budget) and len(self._running) >= self.budget
+
+    def _schedule(self):
+        self._pending.sort(key=lambda job: job.order)
+        for job in list(self._pending):
+            if self._full():
+                break
+            if job.serial in self._running:
+                continue
+            self._pending.remove(job)
+            self._running[job.serial] = job
+            IOLoop.current().spawn_callback(self._execute, job)
+
+    async def _execute(self, job: _Job):
+        try:
+            result = await job.func(*job.args, **job.kwargs)
+        except Preempted:
+            logger.info("[%s] job preempted, queued again", job.serial)
+            self._pending.append(job)  # keeps its seq, so its position
+        except Exception as e:
+            job.future.set_exception(e)
+        else:
+            job.future.set_result(result)
+        finally:
+            self._running.pop(job.serial, None)
+            self._schedule()
+
+    async def checkpoint(self, serial: str):
+        """
+        called by background jobs at points where it is safe to stop
+
+        Raises:
+            Preempted
+        """
+        job = self._running.get(serial)
+        if not job or job.priority < PRIORITY_BACKGROUND:
+            return
+        for other in self._pending:
+            if other.priority >= job.priority:
+                continue
+            if other.serial == serial or (self._full() and
+                                          other.serial not in self._running):
+                raise Preempted()
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self._running),
+            "pending": len(self._pending),
+        }
+
+
+workqueue = WorkQueue()
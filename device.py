@@ -1,25 +1,42 @@
 # coding: utf-8
 #
 
+import json
 import os
+import re
+import signal
 import subprocess
+import time
 import traceback
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
-from adbutils import adb as adbclient
+import adbutils
 from logzero import logger
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+from tornado.tcpclient import TCPClient
 
 import apkutils2 as apkutils
-from asyncadb import adb
+from asyncadb import get_client
 from device_names import device_names
+from core.devicestore import devicestore
 from core.freeport import freeport
+from core.gzpush import gzpush
+from core.transfer import scheduler
+from core.workqueue import workqueue
 from core.utils import current_ip
 from core import fetching
+import settings
 
 STATUS_INIT = "init"
 STATUS_OKAY = "ready"
 STATUS_FAIL = "fail"
 
+READY_TIMEOUT = 20.0  # seconds
+UIAUTOMATOR_TIMEOUT = 40.0  # seconds, some vivo devices take 24s to launch
+
 
 class InitError(Exception):
     """ device init error """
@@ -29,13 +46,41 @@ async def nop_callback(*args, **kwargs):
     pass
 
 
+def adbutils_device(serial: str, origin: str = None):
+    """ adbutils device on the adb server given by origin(host:port) """
+    client = get_client(origin)
+    host, port = client.origin.rsplit(":", 1)
+    return adbutils.AdbClient(host, int(port)).device(serial)
+
+
 class AndroidDevice(object):
-    def __init__(self, serial: str, callback=nop_callback):
+    def __init__(self,
+                 serial: str,
+                 callback=nop_callback,
+                 origin: str = None,
+                 usb: str = None):
+        """
+        Args:
+            origin: address(host:port) of adb server the device connected to
+            usb: usb path reported by adb, eg 1-1.4
+        """
         self._serial = serial
+        scheduler.register(serial, origin, usb)
+        self._adb = get_client(origin)
+        # forwards are opened on the adb server host
+        self._adb_host = "localhost" if self._adb.is_local else \
+            self._adb.origin.rsplit(":", 1)[0]
         self._procs = []
+        self._adopted_pids = []  # started by previous provider process
+        self._agent_adopted = False
+        self._ready_times = {}  # service -> seconds
+        self._warm_time = None  # seconds uiautomator took in last reset
         self._current_ip = current_ip()
-        self._device = adbclient.device(serial)
+        self._device = adbutils_device(serial, origin)
         self._callback = callback
+        self._forwards = {}  # remote -> local port
+        self._properties = None
+        self._fingerprint = None
 
     def __repr__(self):
         return "[" + self._serial + "]"
@@ -44,30 +89,218 @@ class AndroidDevice(object):
     def serial(self):
         return self._serial
 
+    @property
+    def origin(self) -> str:
+        return self._adb.origin
+
+    @property
+    def agent_adopted(self) -> bool:
+        """ running atx-agent was adopted by last init, it may be in use """
+        return self._agent_adopted
+
     async def run_forever(self):
         try:
             await self.init()
         except Exception as e:
             logger.warning("Init failed: %s", e)
 
-    async def init(self):
+    async def init(self, warm: bool = False):
         """
         do forward and start proxy
+
+        Args:
+            warm: adopt forwards, proxies and atx-agent left by the previous
+                provider process when they are still usable
         """
         logger.info("Init device: %s", self._serial)
         self._callback(STATUS_INIT)
+        self._agent_adopted = False
+
+        # pushes may wait for a transfer slot, keep IOLoop running
+        loop = IOLoop.current()
+        await loop.run_in_executor(None, self._init_binaries)
+        await workqueue.checkpoint(self._serial)
+        await loop.run_in_executor(None, self._init_apks)
+        await workqueue.checkpoint(self._serial)
+        await self._init_forwards(warm)
+        if warm:
+            version = await self.agent_version()
+            if version and version == settings.atx_agent_version:
+                logger.debug("%s adopt running atx-agent %s", self, version)
+                self._agent_adopted = True
+                return
+        await self._start_atx_agent()
 
-        self._init_binaries()
-        self._init_apks()
-        await self._init_forwards()
+    async def reconnect(self) -> bool:
+        """
+        fast path when device comes back shortly after unplugged.
+        Binaries, apks and proxies are kept, only adb forwards which are
+        dropped by adb-server are restored.
 
-        await adb.shell(self._serial,
+        Returns:
+            bool: False if a full init is required
+        """
+        if not self._procs and not self._adopted_pids:
+            return False
+        if any(p.poll() is not None for p in self._procs):
+            return False
+        if not all(map(pid_alive, self._adopted_pids)):
+            return False
+        logger.info("Reconnect device: %s", self._serial)
+        for remote, local_port in self._forwards.items():
+            await self._adb.forward(self._serial, "tcp:%d" % local_port, remote)
+        if not await self.agent_version():
+            await self._start_atx_agent()
+        return True
+
+    async def _start_atx_agent(self):
+        await self._adb.shell(self._serial,
                         "/data/local/tmp/atx-agent server --stop")
-        await adb.shell(self._serial,
+        await self._adb.shell(self._serial,
                         "/data/local/tmp/atx-agent server --nouia -d")
 
+    async def agent_version(self, timeout: float = 3.0, port: int = None):
+        """
+        Args:
+            port: local port to request, default is the adb forward port
+
+        Returns:
+            version of running atx-agent, None if not reachable
+        """
+        local_port = port or self._forwards.get("tcp:7912")
+        if not local_port:
+            return None
+        host = "127.0.0.1" if port else self._adb_host
+        url = "http://%s:%d/version" % (host, local_port)
+        try:
+            r = await AsyncHTTPClient().fetch(url, request_timeout=timeout)
+            return r.body.decode().strip()
+        except Exception as e:
+            logger.debug("%s atx-agent not reachable: %s", self, e)
+            return None
+
+    async def wait_ready(self, timeout: float = READY_TIMEOUT) -> float:
+        """
+        poll every service through the provider side address until usable
+
+        Returns:
+            seconds from start to all ready
+
+        Raises:
+            InitError
+        """
+        async def port_open(port: int) -> bool:
+            try:
+                stream = await TCPClient().connect("127.0.0.1", port, timeout=1)
+                stream.close()
+                return True
+            except Exception:
+                return False
+
+        async def atx_agent_ready() -> bool:
+            return bool(await self.agent_version(1.0, self._atx_proxy_port))
+
+        probes = {
+            "atx-agent": atx_agent_ready,
+            # WhatsInput only listens when its IME is enabled, check relay
+            "whatsinput": lambda: port_open(self._whatsinput_port),
+            "adb-bridge": lambda: port_open(self._adb_remote_port),
+        }
+        self._ready_times = {}
+        start = time.time()
+        interval = .05
+        while True:
+            pending = [name for name in probes if name not in self._ready_times]
+            results = await gen.multi([probes[name]() for name in pending])
+            for name, ok in zip(pending, results):
+                if ok:
+                    self._ready_times[name] = time.time() - start
+            if len(self._ready_times) == len(probes):
+                break
+            if time.time() - start > timeout:
+                self._callback(STATUS_FAIL)
+                raise InitError(
+                    "not ready in %.1fs: %s" %
+                    (timeout, ", ".join(set(probes) - set(self._ready_times))))
+            await gen.sleep(interval)
+            interval = min(interval * 2, .5)
+
+        elapsed = time.time() - start
+        logger.info("%s ready in %.2fs, %s", self, elapsed, self._ready_times)
+        self._callback(STATUS_OKAY)
+        return elapsed
+
+    @property
+    def ready_times(self) -> dict:
+        """
+        seconds each service took to be ready in last wait_ready, and
+        uiautomator warm up time of last reset
+        """
+        times = dict(self._ready_times)
+        if self._warm_time is not None:
+            times['uiautomator'] = self._warm_time
+        return times
+
+    async def warm_uiautomator(self,
+                               timeout: float = UIAUTOMATOR_TIMEOUT) -> float:
+        """
+        restart uiautomator service through atx-agent and wait until it
+        answers jsonrpc, so the first call of next user does not pay for it
+
+        Returns:
+            seconds from start to ready
+
+        Raises:
+            InitError
+        """
+        # keep uiautomator process out of doze mode
+        await self._adb.shell(
+            self._serial, "dumpsys deviceidle whitelist +com.github.uiautomator;"
+            " dumpsys deviceidle whitelist +com.github.uiautomator.test")
+
+        base_url = "http://%s:%d" % (self._adb_host,
+                                     self._forwards["tcp:7912"])
+        jsonrpc = json.dumps({
+            "jsonrpc": "2.0",
+            "id": 1,
+            "method": "deviceInfo",
+        })
+
+        async def request(path: str, method: str = "GET", body=None):
+            try:
+                return await AsyncHTTPClient().fetch(base_url + path,
+                                                     method=method,
+                                                     body=body,
+                                                     request_timeout=3,
+                                                     raise_error=False)
+            except Exception as e:  # atx-agent is not listening yet
+                logger.debug("%s %s %s: %s", self, method, path, e)
+                return None
+
+        start = time.time()
+        started = False
+        interval = .2
+        while time.time() - start < timeout:
+            if not started:
+                # atx-agent started with --nouia, kill instrument left over
+                await request("/services/uiautomator", "DELETE")
+                r = await request("/services/uiautomator", "POST", b"")
+                started = r is not None and r.code == 200
+            else:
+                r = await request("/jsonrpc/0", "POST", jsonrpc)
+                if r is not None and r.code == 200 and \
+                        not json.loads(r.body).get("error"):
+                    self._warm_time = time.time() - start
+                    logger.info("%s uiautomator warm in %.2fs", self,
+                                self._warm_time)
+                    return self._warm_time
+            await gen.sleep(interval)
+            interval = min(interval * 2, 1.0)
+        self._callback(STATUS_FAIL)
+        raise InitError("uiautomator not ready in %.1fs" % timeout)
+
     async def open_identify(self):
-        await adb.shell(
+        await self._adb.shell(
             self._serial,
             "am start -n com.github.uiautomator/.IdentifyActivity -e theme black"
         )
@@ -75,6 +308,7 @@ class AndroidDevice(object):
     def _init_binaries(self):
         # minitouch, minicap, minicap.so
         d = self._device
+        self._fingerprint = d.getprop("ro.build.fingerprint")
         sdk = d.getprop("ro.build.version.sdk")  # eg 26
         abi = d.getprop('ro.product.cpu.abi')  # eg arm64-v8a
         abis = (d.getprop('ro.product.cpu.abilist').strip() or abi).split(",")
@@ -127,51 +361,122 @@ class AndroidDevice(object):
                 logger.warning("stf stuff %s not found", path)
                 return
             src_info = z.getinfo(path)
+            # one stat is cheap, do it every time so that a wiped
+            # /data/local/tmp is repaired
             dest_info = self._device.sync.stat(dest)
             if dest_info.size == src_info.file_size and dest_info.mode & mode == mode:
                 logger.debug("%s already pushed %s", self, path)
-                return
-            with z.open(path) as f:
-                self._device.sync.push(f, dest, mode)
+            else:
+                with z.open(path) as f, scheduler.slot(self._serial):
+                    gzpush.push(self._device, f, dest, mode,
+                                src_info.file_size)
 
     def _init_apks(self):
-        whatsinput_apk_path = fetching.get_whatsinput_apk()
-        self._install_apk(whatsinput_apk_path)
-        for apk_path in fetching.get_uiautomator_apks():
-            print("APKPath:", apk_path)
-            self._install_apk(apk_path)
-
-    def _install_apk(self, path: str):
+        apk_paths = [fetching.get_whatsinput_apk()]
+        apk_paths.extend(fetching.get_uiautomator_apks())
+        versions = self._package_versions()
+        if versions is not None:
+            # verified before and still installed, skip apk parsing and
+            # package_info. apps removed without /cold are installed again
+            apk_paths = [
+                path for path in apk_paths
+                if not self._apk_verified(path, versions)
+            ]
+        if not apk_paths:
+            logger.debug("%s all apks already verified", self)
+            return
+        with ThreadPoolExecutor(len(apk_paths)) as executor:
+            for apk_path in apk_paths:
+                print("APKPath:", apk_path)
+                executor.submit(self._install_apk, apk_path, versions)
+
+    def _apk_digest(self, path: str) -> str:
+        """ Returns: digest used by devicestore, target is package name """
         assert path, "Invalid %s" % path
+        st = os.stat(path)
+        return "%s:%d:%d" % (os.path.abspath(path), st.st_size, st.st_mtime)
+
+    def _apk_verified(self, path: str, versions: dict) -> bool:
+        package_name = devicestore.verified_target(self._serial,
+                                                   self._fingerprint,
+                                                   self._apk_digest(path))
+        return package_name in versions
+
+    def _package_versions(self) -> dict:
+        """
+        list installed packages with one pm call
+
+        Returns:
+            dict of package name -> version code, version code is None when
+            pm does not support --show-versioncode (before Android 9).
+            None if no package listed at all
+        """
+        versions = self._list_packages("pm list packages --show-versioncode")
+        if not versions:
+            # older pm rejects the flag, prints an error and lists nothing
+            versions = self._list_packages("pm list packages")
+        return versions or None
+
+    def _list_packages(self, cmd: str) -> dict:
+        output = self._device.shell(cmd)
+        versions = {}
+        for line in output.splitlines():
+            m = re.match(r"package:(\S+)(?:\s+versionCode:(\d+))?", line.strip())
+            if m:
+                versions[m.group(1)] = m.group(2)
+        return versions
+
+    def _install_apk(self, path: str, versions: dict = None):
         try:
+            digest = self._apk_digest(path)
             m = apkutils.APK(path).manifest
-            info = self._device.package_info(m.package_name)
-            if info and m.version_code == info[
-                    'version_code'] and m.version_name == info['version_name']:
+            if versions is not None and m.package_name not in versions:
+                info, installed = None, False
+            elif versions is None or versions[m.package_name] is None:
+                info = self._device.package_info(m.package_name)
+                installed = info and m.version_code == info[
+                    'version_code'] and m.version_name == info['version_name']
+            else:
+                info = versions[m.package_name]
+                installed = str(m.version_code) == info
+            if installed:
                 logger.debug("%s already installed %s", self, path)
             else:
                 print(info, ":", m.version_code, m.version_name)
                 logger.debug("%s install %s", self, path)
-                self._device.install(path)
+                # apks are installed in parallel, each needs its own remote
+                # path (device.install pushes all of them to unknown.apk)
+                dst = "/data/local/tmp/%s.apk" % m.package_name
+                with scheduler.slot(self._serial):
+                    with open(path, "rb") as f:
+                        gzpush.push(self._device, f, dst, 0o644,
+                                    os.path.getsize(path))
+                    try:
+                        self._device.install_remote(dst)
+                    finally:
+                        self._device.shell(["rm", "-f", dst])
+            devicestore.mark_verified(self._serial, self._fingerprint,
+                                      m.package_name, digest)
         except Exception as e:
             traceback.print_exc()
             logger.warning("%s Install apk %s error %s", self, path, e)
 
-    async def _init_forwards(self):
+    async def _init_forwards(self, warm: bool = False):
         logger.debug("%s forward atx-agent", self)
-        self._atx_proxy_port = await self.proxy_device_port(7912)
-        self._whatsinput_port = await self.proxy_device_port(6677)
-
-        port = self._adb_remote_port = freeport.get()
+        self._atx_proxy_port = await self.proxy_device_port(7912, warm)
+        self._whatsinput_port = await self.proxy_device_port(6677, warm)
+
+        def adbkit_args(port: int):
+            return [
+                'node', 'node_modules/adbkit/bin/adbkit', 'usb-device-to-tcp',
+                '-p',
+                str(port), self._serial
+            ]
+
+        port = self._adb_remote_port = self._start_or_adopt(
+            "adbkit", adbkit_args, warm)
         logger.debug("%s adbkit start, port %d", self, port)
 
-        self.run_background([
-            'node', 'node_modules/adbkit/bin/adbkit', 'usb-device-to-tcp',
-            '-p',
-            str(self._adb_remote_port), self._serial
-        ],
-                            silent=True)
-
     def addrs(self):
         def port2addr(port):
             return self._current_ip + ":" + str(port)
@@ -182,69 +487,145 @@ class AndroidDevice(object):
             "whatsInputAddress": port2addr(self._whatsinput_port),
         }
 
+    async def screenshot(self, timeout: float = 10.0) -> bytes:
+        """ jpeg screenshot taken by atx-agent """
+        url = "http://%s:%d/screenshot/0" % (self._adb_host,
+                                             self._forwards["tcp:7912"])
+        r = await AsyncHTTPClient().fetch(url, request_timeout=timeout)
+        return r.body
+
+    @property
+    def minicap_url(self) -> str:
+        """ screen stream websocket of atx-agent """
+        return "ws://%s:%d/minicap" % (self._adb_host,
+                                       self._forwards["tcp:7912"])
+
+    def relay_ports(self) -> set:
+        """ local ports which users connect to """
+        return {
+            port
+            for port in (self._atx_proxy_port, self._adb_remote_port,
+                         self._whatsinput_port) if port
+        }
+
     def adb_call(self, *args):
         """ call adb with serial """
-        cmds = ['adb', '-s', self._serial] + list(args)
+        host, port = self._adb.origin.rsplit(":", 1)
+        cmds = ['adb', '-H', host, '-P', port, '-s', self._serial] + list(args)
         logger.debug("RUN: %s", subprocess.list2cmdline(cmds))
         return subprocess.call(cmds)
 
     async def adb_forward_to_any(self, remote: str) -> int:
         """ FIXME(ssx): not finished yet """
         # if already forwarded, just return
-        async for f in adb.forward_list():
+        async for f in self._adb.forward_list():
             if f.serial == self._serial:
                 if f.remote == remote and f.local.startswith("tcp:"):
-                    return int(f.local[4:])
+                    self._forwards[remote] = int(f.local[4:])
+                    return self._forwards[remote]
 
         local_port = freeport.get()
-        await adb.forward(self._serial, 'tcp:{}'.format(local_port), remote)
+        await self._adb.forward(self._serial, 'tcp:{}'.format(local_port), remote)
+        self._forwards[remote] = local_port
         return local_port
 
-    async def proxy_device_port(self, device_port: int) -> int:
+    async def proxy_device_port(self, device_port: int,
+                                warm: bool = False) -> int:
         """ reverse-proxy device:port to *:port """
         local_port = await self.adb_forward_to_any("tcp:" + str(device_port))
-        listen_port = freeport.get()
+
+        def tcpproxy_args(port: int):
+            return [
+                'node', 'tcpproxy.js',
+                str(port), self._adb_host,
+                str(local_port)
+            ]
+
+        listen_port = self._start_or_adopt("tcpproxy:%d" % device_port,
+                                           tcpproxy_args, warm)
         logger.debug("%s tcpproxy.js start *:%d -> %d", self, listen_port,
                      local_port)
-        self.run_background([
-            'node', 'tcpproxy.js',
-            str(listen_port), 'localhost',
-            str(local_port)
-        ],
-                            silent=True)
         return listen_port
 
+    def _start_or_adopt(self, key: str, make_args, warm: bool) -> int:
+        """
+        start a background helper listening on a free port. When warm is set,
+        adopt the same helper started by previous provider process instead,
+        otherwise the recorded one is stopped.
+
+        Args:
+            key: name of the helper
+            make_args: func(port) -> list of command args
+
+        Returns:
+            listen port
+        """
+        state = devicestore.get_state(self._serial, key)
+        if state and pid_match(state['pid'], state['args']):
+            if warm and state['args'] == make_args(state['port']) \
+                    and freeport.is_port_in_use(state['port']):
+                logger.debug("%s adopt %s, pid: %d, port: %d", self, key,
+                             state['pid'], state['port'])
+                self._adopted_pids.append(state['pid'])
+                return state['port']
+            logger.debug("%s stop stale %s, pid: %d", self, key, state['pid'])
+            os.kill(state['pid'], signal.SIGTERM)
+
+        port = freeport.get()
+        args = make_args(port)
+        p = self.run_background(args, silent=True)
+        devicestore.set_state(self._serial, key, {
+            "args": args,
+            "port": port,
+            "pid": p.pid,
+        })
+        return port
+
     def run_background(self, *args, **kwargs):
         silent = kwargs.pop('silent', False)
         if silent:
             kwargs['stdout'] = subprocess.DEVNULL
             kwargs['stderr'] = subprocess.DEVNULL
+        if not self._adb.is_local:
+            # adbkit reads ADB_HOST and ADB_PORT
+            host, port = self._adb.origin.rsplit(":", 1)
+            kwargs['env'] = dict(os.environ, ADB_HOST=host, ADB_PORT=port)
+        if settings.warm_start:
+            # keep running after provider exit, so it can be adopted
+            kwargs['start_new_session'] = True
         p = subprocess.Popen(*args, **kwargs)
         self._procs.append(p)
         return p
 
     async def getprop(self, name: str) -> str:
-        value = await adb.shell(self._serial, "getprop " + name)
+        value = await self._adb.shell(self._serial, "getprop " + name)
         return value.strip()
 
     async def properties(self):
+        if self._properties:
+            return self._properties
         brand = await self.getprop("ro.product.brand")
         model = await self.getprop("ro.product.model")
         version = await self.getprop("ro.build.version.release")
 
-        return {
+        self._properties = {
             "serial": self._serial,
             "brand": brand,
             "version": version,
             "model": model,
             "name": device_names.get(model, model),
         }
+        return self._properties
 
     async def reset(self):
         """ 設備使用完后的清理工作 """
         self.close()
-        await adb.shell(self._serial, "input keyevent HOME")
+        # user may have removed anything during the session, verify again
+        devicestore.forget(self._serial)
+        await self._adb.shell(self._serial, "input keyevent HOME")
         await self.init()
+        self._warm_time = None
+        await self.warm_uiautomator()
 
     def wait(self):
         for p in self._procs:
@@ -254,3 +635,57 @@ class AndroidDevice(object):
         for p in self._procs:
             p.terminate()
         self._procs = []
+        for pid in self._adopted_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        self._adopted_pids = []
+
+
+def stop_helpers(serials):
+    """ stop background helpers recorded for devices, and drop their states """
+    for serial, key, state in devicestore.states():
+        if serial not in serials:
+            continue
+        if pid_match(state['pid'], state['args']):
+            logger.info("Device:%s stop %s, pid: %d", serial, key,
+                        state['pid'])
+            os.kill(state['pid'], signal.SIGTERM)
+        devicestore.drop_state(serial, key)
+
+
+def stop_orphans(present):
+    """
+    stop helpers recorded by previous provider processes for devices which
+    did not come back
+
+    Args:
+        present: serials seen since start
+    """
+    stop_helpers({
+        serial
+        for serial, _, _ in devicestore.states() if serial not in present
+    })
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def pid_match(pid: int, args: list) -> bool:
+    """ check process is alive and (if /proc exists) started with args """
+    if not pid_alive(pid):
+        return False
+    try:
+        with open("/proc/%d/cmdline" % pid, "rb") as f:
+            cmdline = f.read().decode(errors='replace').rstrip("\0")
+    except OSError:
+        return True
+    return cmdline.split("\0") == args
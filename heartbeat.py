@@ -151,6 +151,15 @@ class HeartbeatConnection(object):
 
         await self._queue.put(data)
 
+    @property
+    def priority(self) -> int:
+        return self._priority
+
+    async def set_priority(self, priority: int):
+        """ tell server the new priority, also used by later handshakes """
+        self._priority = priority
+        await self._queue.put({"command": "priority", "priority": priority})
+
     async def ping(self):
         await self._ws.write_message({"command": "ping"})
 
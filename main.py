@@ -3,11 +3,14 @@
 #
 
 import argparse
+import collections
 import glob
 import hashlib
+import json
 import os
 import re
 import shutil
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
@@ -16,16 +19,36 @@ import apkutils2 as apkutils
 import requests
 import tornado.web
 from logzero import logger
+from tornado import gen, locks, websocket
 from tornado.concurrent import run_on_executor
 from tornado.ioloop import IOLoop
 
 import adbutils
-from adbutils import adb as adbclient
-from asyncadb import adb
-from device import STATUS_OKAY, AndroidDevice
+from asyncadb import AdbTimeout, adb, get_client, track_devices_all
+from device import (STATUS_OKAY, AndroidDevice, InitError, adbutils_device,
+                    stop_orphans)
 from heartbeat import heartbeat_connect
+from sharding import (Coordinator, ShardDevicesHandler, ShardJobHandler,
+                      ShardJobProgressHandler, ShardLoadHandler,
+                      ShardLogcatHandler, ShardLoopHandler, ShardProxyHandler,
+                      ShardScreenHandler, ShardShellHandler,
+                      ShardThumbnailHandler, ShardUploadHandler,
+                      WorkerChannel, port_block)
 from core.utils import current_ip, id_generator
-from core import fetching
+from core import fetching, loadscore
+from core.apkcache import apkcache
+from core.cors import CorsMixin
+from core.devicestore import devicestore
+from core.gzpush import gzpush
+from core.freeport import freeport
+from core.logcat import LogcatSubscriber, LogFilter, logcats
+from core.looplag import loopmonitor
+from core.screenhub import Subscriber, screenhub
+from core.thumbnail import thumbnails
+from core.jobs import STATUS_FAILED, STATUS_RUNNING, STATUS_SUCCESS, jobs
+from core.transfer import scheduler
+from core.workqueue import (PRIORITY_BACKGROUND, PRIORITY_COLD,
+                            PRIORITY_INTERACTIVE, workqueue)
 import uiautomator2 as u2
 import settings
 
@@ -33,23 +56,9 @@ __curdir__ = os.path.dirname(os.path.abspath(__file__))
 hbconn = None
 udid2device = {}
 secret = id_generator(10)
-
-
-class CorsMixin(object):
-    CORS_ORIGIN = '*'
-    CORS_METHODS = 'GET,POST,OPTIONS'
-    CORS_CREDENTIALS = True
-    CORS_HEADERS = "x-requested-with,authorization"
-
-    def set_default_headers(self):
-        self.set_header("Access-Control-Allow-Origin", self.CORS_ORIGIN)
-        self.set_header("Access-Control-Allow-Headers", self.CORS_HEADERS)
-        self.set_header('Access-Control-Allow-Methods', self.CORS_METHODS)
-
-    def options(self):
-        # no body
-        self.set_status(204)
-        self.finish()
+INIT_RETRIES = 2
+REMOVE_DELAY = 5.0  # seconds
+ORPHAN_DELAY = 30.0  # seconds after start, helpers of absent devices stopped
 
 
 class InstallError(Exception):
@@ -58,10 +67,64 @@ class InstallError(Exception):
         self.reason = reason
 
 
-def app_install_local(serial: str, apk_path: str, launch: bool = False) -> str:
+# pm install errors which can only be solved by uninstall
+INSTALL_CONFLICTS = re.compile(
+    r"INSTALL_FAILED_(UPDATE_INCOMPATIBLE|VERSION_DOWNGRADE|"
+    r"INCONSISTENT_CERTIFICATES|SHARED_USER_INCOMPATIBLE)")
+
+
+def nop_progress(**kwargs):
+    pass
+
+
+class ProgressReader(object):
+    """ file wrapper which reports bytes already read """
+
+    def __init__(self, fileobj, callback):
+        self._fileobj = fileobj
+        self._callback = callback
+        self._nbytes = 0
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._nbytes += len(data)
+        self._callback(self._nbytes)
+        return data
+
+
+def file_sha256(path: str) -> str:
+    m = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def same_apk_installed(device, remote_path: str, digest: str) -> bool:
+    """ compare installed apk with sha256 digest of local one """
+    output = device.shell(["sha256sum", remote_path])
+    m = re.match(r"([0-9a-f]{64})\s", output)
+    if not m:  # sha256sum not supported (before Android 6)
+        return False
+    return m.group(1) == digest
+
+
+def app_install_local(serial: str,
+                      apk_path: str,
+                      launch: bool = False,
+                      origin: str = None,
+                      progress=nop_progress,
+                      smart: bool = False) -> str:
     """
     install apk to device
 
+    Args:
+        origin: adb server address(host:port) of device
+        progress: func(**kwargs) called with stage and pushed bytes
+        smart: keep the installed package when possible. Skip if the same
+            apk is installed, otherwise upgrade in place with install -r and
+            only uninstall on signature or downgrade conflicts
+
     Returns:
         package name
 
@@ -69,7 +132,7 @@ def app_install_local(serial: str, apk_path: str, launch: bool = False) -> str:
         AdbInstallError, FileNotFoundError
     """
     # 解析apk文件
-    device = adbclient.device(serial)
+    device = adbutils_device(serial, origin)
     try:
         apk = apkutils.APK(apk_path)
     except apkutils.apkfile.BadZipFile:
@@ -77,25 +140,63 @@ def app_install_local(serial: str, apk_path: str, launch: bool = False) -> str:
 
     # 提前将重名包卸载
     package_name = apk.manifest.package_name
+    digest = file_sha256(apk_path)
     pkginfo = device.package_info(package_name)
-    if pkginfo:
+    if pkginfo and smart:
+        if same_apk_installed(device, pkginfo['path'], digest):
+            logger.debug("already installed: %s, skip", package_name)
+            progress(stage="skip", packageName=package_name)
+            if launch:
+                logger.debug("launch %s", package_name)
+                progress(stage="launch")
+                device.app_start(package_name)
+            return package_name
+    elif pkginfo:
         logger.debug("uninstall: %s", package_name)
+        progress(stage="uninstall", packageName=package_name)
         device.uninstall(package_name)
 
     # 解锁手机，防止锁屏
     # ud = u2.connect_usb(serial)
     # ud.open_identify()
-    try:
-        # 推送到手机
-        dst = "/data/local/tmp/tmp-%d.apk" % int(time.time() * 1000)
+    total = os.path.getsize(apk_path)
+
+    def push(dst: str):
         logger.debug("push %s %s", apk_path, dst)
-        device.sync.push(apk_path, dst)
+        with open(apk_path, "rb") as f, scheduler.slot(serial):
+            gzpush.push(device,
+                        f,
+                        dst,
+                        size=total,
+                        wrap=lambda f: ProgressReader(
+                            f, lambda n: progress(throttle=True, pushed=n)))
+
+    # 推送到手机，设备上已缓存的直接使用
+    progress(stage="push", pushed=0, pushTotal=total)
+    dst = apkcache.lookup(device, digest, total)
+    if dst:
+        logger.debug("use cached %s", dst)
+    else:
+        dst = apkcache.store(device, digest, total, push)
+    try:
         logger.debug("install-remote %s", dst)
         # 调用pm install安装
-        device.install_remote(dst)
+        progress(stage="install", pushed=total)
+        try:
+            device.install_remote(dst)
+        except adbutils.AdbInstallError as e:
+            if not (smart and pkginfo and INSTALL_CONFLICTS.search(e.output)):
+                raise
+            logger.debug("install -r %s conflict: %s, uninstall first",
+                         package_name, e.output.strip())
+            progress(stage="uninstall", packageName=package_name)
+            device.uninstall(package_name)
+            progress(stage="install")
+            device.install_remote(dst)
     except adbutils.AdbInstallError as e:
         raise InstallError("install", e.output)
-    # finally:
+    finally:
+        apkcache.release(device, dst)
     # 停止uiautomator2服务
     # logger.debug("uiautomator2 stop")
     # ud.session().press("home")
@@ -104,6 +205,7 @@ def app_install_local(serial: str, apk_path: str, launch: bool = False) -> str:
     # 启动应用
     if launch:
         logger.debug("launch %s", package_name)
+        progress(stage="launch")
         device.app_start(package_name)
     return package_name
 
@@ -111,6 +213,28 @@ def app_install_local(serial: str, apk_path: str, launch: bool = False) -> str:
 class AppHandler(CorsMixin, tornado.web.RequestHandler):
     _install_executor = ThreadPoolExecutor(4)
     _download_executor = ThreadPoolExecutor(1)
+    _cache_lock = threading.Lock()
+    _in_use = collections.Counter()  # cached apk path -> installs using it
+
+    def acquire_cache(self, path: str) -> str:
+        """ keep path from being removed until release_cache """
+        with self._cache_lock:
+            self._in_use[path] += 1
+        return path
+
+    def release_cache(self, path: str):
+        with self._cache_lock:
+            self._in_use[path] -= 1
+            if self._in_use[path] <= 0:
+                del self._in_use[path]
+
+    def remove_unused(self, paths: list):
+        """ remove cached files which are not being installed """
+        with self._cache_lock:
+            for path in paths:
+                if path not in self._in_use and os.path.exists(path):
+                    logger.debug("Remove old cache: %s", path)
+                    os.unlink(path)
 
     def cache_filepath(self, text: str) -> str:
         m = hashlib.md5()
@@ -118,33 +242,82 @@ class AppHandler(CorsMixin, tornado.web.RequestHandler):
         return "cache-" + m.hexdigest()
 
     @run_on_executor(executor="_download_executor")
-    def cache_download(self, url: str) -> str:
-        """ download with local cache """
+    def cache_download(self, url: str, progress=nop_progress) -> str:
+        """ Returns: path of cached apk, call release_cache after use """
+        return self.acquire_cache(self._cache_download(url, progress))
+
+    def _cache_download(self, url: str, progress=nop_progress) -> str:
+        """
+        download with local cache
+
+        Cached file is revalidated with ETag/Last-Modified of the last
+        download once it is older than settings.apk_url_ttl seconds
+
+        Args:
+            progress: func(**kwargs) called with downloaded bytes
+        """
         target_path = self.cache_filepath(url)
+        meta_path = target_path + ".json"
         logger.debug("Download %s to %s", url, target_path)
 
-        if os.path.exists(target_path):
-            logger.debug("Cache hited")
+        meta = {}
+        if os.path.exists(target_path) and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if time.time() - meta['checked'] < settings.apk_url_ttl:
+                logger.debug("Cache hited")
+                return target_path
+
+        headers = {}
+        if meta.get("etag"):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get("lastModified"):
+            headers['If-Modified-Since'] = meta['lastModified']
+        try:
+            r = requests.get(url, headers=headers, stream=True)
+        except requests.RequestException as e:
+            if not meta:
+                raise
+            logger.warning("Revalidate %s failed: %s, use cache", url, e)
+            return target_path
+
+        if r.status_code == 304 and meta:
+            logger.debug("Cache not modified")
+            r.close()
+            meta['checked'] = time.time()
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
             return target_path
+        r.raise_for_status()
 
         # TODO: remove last
-        for fname in glob.glob("cache-*"):
-            logger.debug("Remove old cache: %s", fname)
-            os.unlink(fname)
+        self.remove_unused([
+            fname for fname in glob.glob("cache-*")
+            if fname not in (target_path, meta_path)
+        ])
 
         tmp_path = target_path + ".tmp"
-        r = requests.get(url, stream=True)
-        r.raise_for_status()
-
         with open(tmp_path, "wb") as tfile:
             content_length = int(r.headers.get("content-length", 0))
             if content_length:
+                downloaded = 0
                 for chunk in r.iter_content(chunk_size=40960):
                     tfile.write(chunk)
+                    downloaded += len(chunk)
+                    progress(throttle=True,
+                             downloaded=downloaded,
+                             downloadTotal=content_length)
             else:
                 shutil.copyfileobj(r.raw, tfile)
 
         os.rename(tmp_path, target_path)
+        with open(meta_path, "w") as f:
+            json.dump({
+                "url": url,
+                "etag": r.headers.get("ETag"),
+                "lastModified": r.headers.get("Last-Modified"),
+                "checked": time.time(),
+            }, f)
         return target_path
 
     @run_on_executor(executor='_install_executor')
@@ -156,18 +329,62 @@ class AppHandler(CorsMixin, tornado.web.RequestHandler):
             "packageName": pkg_name,
         }
 
+    async def fetch_apk(self, progress=nop_progress) -> str:
+        """ Returns: local path of apk to install, released after install """
+        progress(status=STATUS_RUNNING, stage="download")
+        return await self.cache_download(self.get_argument("url"), progress)
+
+    def job_info(self) -> dict:
+        return {"url": self.get_argument("url")}
+
+    async def install(self, device, launch: bool,
+                      progress=nop_progress) -> dict:
+        apk_path = await self.fetch_apk(progress)
+        progress(status=STATUS_RUNNING, stage="queued")
+        smart = self.get_argument("smart",
+                                  "false") in ['true', 'True', 'TRUE', '1']
+        try:
+            return await workqueue.run(device.serial,
+                                       PRIORITY_INTERACTIVE,
+                                       self.app_install_url,
+                                       device.serial,
+                                       apk_path,
+                                       launch=launch,
+                                       origin=device.origin,
+                                       progress=progress,
+                                       smart=smart)
+        finally:
+            self.release_cache(apk_path)
+
+    async def install_job(self, job, device, launch: bool):
+        try:
+            ret = await self.install(device, launch, job.update)
+            job.update(status=STATUS_SUCCESS, stage="done", result=ret)
+        except InstallError as e:
+            job.update(status=STATUS_FAILED,
+                       description="{}: {}".format(e.stage, e.reason))
+        except Exception as e:
+            job.update(status=STATUS_FAILED, description=str(e))
+
     async def post(self, udid=None):
         udid = udid or self.get_argument("udid")
         device = udid2device[udid]
-        url = self.get_argument("url")
         launch = self.get_argument("launch",
                                    "false") in ['true', 'True', 'TRUE', '1']
 
+        if self.get_argument("async", "false") in ['true', 'True', 'TRUE', '1']:
+            job = jobs.create(udid=udid, **self.job_info())
+            IOLoop.current().spawn_callback(self.install_job, job, device,
+                                            launch)
+            self.write({
+                "success": True,
+                "description": "Job created",
+                "jobId": job.id,
+            })
+            return
+
         try:
-            apk_path = await self.cache_download(url)
-            ret = await self.app_install_url(device.serial,
-                                             apk_path,
-                                             launch=launch)
+            ret = await self.install(device, launch)
             self.write(ret)
         except InstallError as e:
             self.set_status(400)
@@ -180,6 +397,242 @@ class AppHandler(CorsMixin, tornado.web.RequestHandler):
             self.write(str(e))
 
 
+@tornado.web.stream_request_body
+class AppUploadHandler(AppHandler):
+    """
+    install apk from request body, the last UPLOAD_CACHE_SIZE uploads are
+    kept by sha256 (apart from downloads, which are cleaned separately).
+
+    When query sha256 is given and that apk is already cached, the body is
+    not needed and can be empty.
+    """
+    UPLOAD_CACHE_SIZE = 10
+
+    def prepare(self):
+        self._tmpfile = None
+        self._apk_path = None
+        if self.request.method != "POST":
+            return
+        if self.get_argument("udid") not in udid2device:
+            raise tornado.web.HTTPError(404, "Device not found")
+
+        self.request.connection.set_max_body_size(settings.max_upload_size)
+        self.request.connection.set_body_timeout(3600)
+        expect = self.get_argument("sha256", "").lower()
+        if expect and os.path.exists(self.cache_filepath_sha256(expect)):
+            logger.debug("Upload cache hited: %s", expect)
+            self._digest = expect
+            self._apk_path = self._use_upload(
+                self.cache_filepath_sha256(expect))
+            return
+        self._sha256 = hashlib.sha256()
+        self._tmp_path = "upload-%s.tmp" % id_generator(10)
+        self._tmpfile = open(self._tmp_path, "wb")
+
+    def data_received(self, chunk: bytes):
+        if self._tmpfile:
+            self._sha256.update(chunk)
+            self._tmpfile.write(chunk)
+
+    def on_finish(self):
+        if self._tmpfile:  # request aborted or failed
+            self._close_tmpfile(remove=True)
+
+    def on_connection_close(self):
+        self.on_finish()
+
+    def _close_tmpfile(self, remove=False):
+        self._tmpfile.close()
+        self._tmpfile = None
+        if remove and os.path.exists(self._tmp_path):
+            os.unlink(self._tmp_path)
+
+    def cache_filepath_sha256(self, digest: str) -> str:
+        # not matched by cache-* which cache_download cleans up
+        return "upload-sha256-" + digest
+
+    def _use_upload(self, path: str) -> str:
+        """ mark as recently used, drop the oldest ones """
+        self.acquire_cache(path)
+        os.utime(path)
+        uploads = sorted(glob.glob("upload-sha256-*"),
+                         key=os.path.getmtime,
+                         reverse=True)
+        self.remove_unused(uploads[self.UPLOAD_CACHE_SIZE:])
+        return path
+
+    def _save_upload(self) -> str:
+        """ move uploaded file into cache """
+        nbytes = self._tmpfile.tell()
+        digest = self._sha256.hexdigest()
+        if nbytes == 0:
+            self._close_tmpfile(remove=True)
+            raise InstallError("upload", "cache missed, apk required in body")
+        expect = self.get_argument("sha256", "").lower()
+        if expect and expect != digest:
+            self._close_tmpfile(remove=True)
+            raise InstallError(
+                "upload", "sha256 mismatch, expect %s, got %s" % (expect, digest))
+        self._digest = digest
+
+        target_path = self.cache_filepath_sha256(digest)
+        if os.path.exists(target_path):
+            logger.debug("Upload cache hited: %s", digest)
+            self._close_tmpfile(remove=True)
+        else:
+            self._close_tmpfile()
+            os.rename(self._tmp_path, target_path)
+        return self._use_upload(target_path)
+
+    async def fetch_apk(self, progress=nop_progress) -> str:
+        return self._apk_path
+
+    def job_info(self) -> dict:
+        return {"sha256": self._digest}
+
+    async def post(self, udid=None):
+        if not self._apk_path:
+            try:
+                self._apk_path = self._save_upload()
+            except InstallError as e:
+                self.set_status(400)
+                self.write({
+                    "success": False,
+                    "description": "{}: {}".format(e.stage, e.reason)
+                })
+                return
+        await super().post(udid)
+
+
+class InstallJobHandler(CorsMixin, tornado.web.RequestHandler):
+    def get(self, job_id: str):
+        job = jobs.get(job_id)
+        if not job:
+            self.set_status(404)
+            self.write({"success": False, "description": "Job not found"})
+            return
+        self.write(job.state)
+
+
+class InstallProgressHandler(websocket.WebSocketHandler):
+    """ push job state on every change, closed when job is done """
+
+    def check_origin(self, origin):
+        return True
+
+    def open(self, job_id: str):
+        self._job = jobs.get(job_id)
+        if not self._job:
+            self.close(4004, "Job not found")
+            return
+        self.write_message(self._job.state)
+        if self._job.done:
+            self.close()
+            return
+        self._job.subscribe(self._on_update)
+
+    def _on_update(self, state: dict):
+        try:
+            self.write_message(state)
+        except websocket.WebSocketClosedError:
+            return
+        if self._job.done:
+            self.close()
+
+    def on_close(self):
+        if self._job:
+            self._job.unsubscribe(self._on_update)
+
+
+class ScreenHandler(websocket.WebSocketHandler):
+    """ minicap frames of device, one upstream shared by all viewers """
+
+    def initialize(self):
+        self._stream = None
+        self._subscriber = Subscriber(self)
+
+    def check_origin(self, origin):
+        return True
+
+    def open(self, udid: str):
+        device = udid2device.get(udid)
+        if not device:
+            self.close(4004, "Device not found")
+            return
+        self._stream = screenhub.stream(udid, device.minicap_url)
+        self._stream.subscribe(self._subscriber)
+
+    def on_close(self):
+        if self._stream:
+            self._stream.unsubscribe(self._subscriber)
+
+
+class LogcatHandler(websocket.WebSocketHandler):
+    """ logcat lines of device, one reader shared by all subscribers
+
+    Query: level=W&tag=ActivityManager&pid=123&grep=regex&tail=100
+    """
+
+    def initialize(self):
+        self._stream = None
+        self._subscriber = None
+
+    def check_origin(self, origin):
+        return True
+
+    def open(self, udid: str):
+        device = udid2device.get(udid)
+        if not device:
+            self.close(4004, "Device not found")
+            return
+        try:
+            pid = self.get_argument("pid", None)
+            filters = LogFilter(level=self.get_argument("level", None),
+                                tag=self.get_argument("tag", None),
+                                pid=int(pid) if pid else None,
+                                grep=self.get_argument("grep", None))
+            tail = int(self.get_argument("tail", 100))
+        except (ValueError, re.error) as e:
+            self.close(4000, "Invalid filter: %s" % e)
+            return
+        self._subscriber = LogcatSubscriber(self, filters, tail)
+        self._stream = logcats.stream(udid, get_client(device.origin),
+                                      device.serial)
+        self._stream.subscribe(self._subscriber)
+
+    def on_close(self):
+        if self._stream:
+            self._stream.unsubscribe(self._subscriber)
+
+
+class ThumbnailHandler(CorsMixin, tornado.web.RequestHandler):
+    async def get(self, udid: str):
+        """ downscaled screenshot, refreshed every --thumbnail-interval """
+        device = udid2device.get(udid)
+        if not device:
+            self.set_status(404)
+            self.write({"success": False, "description": "Device not found"})
+            return
+
+        async def capture() -> bytes:
+            # free when someone is watching the screen stream
+            return screenhub.last_frame(udid) or await device.screenshot()
+
+        thumbnail = await thumbnails.get(udid, capture)
+        if not thumbnail:
+            self.set_status(503)
+            self.write({"success": False, "description": "Screenshot failed"})
+            return
+        self.set_header("Etag", '"%s"' % thumbnail.etag)
+        self.set_header("Cache-Control",
+                        "max-age=%d" % int(thumbnails.interval))
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.set_header("Content-Type", "image/jpeg")
+        self.write(thumbnail.data)
+
+
 class ColdingHandler(tornado.web.RequestHandler):
     async def post(self, udid=None):
         """ 设备清理 """
@@ -195,7 +648,12 @@ class ColdingHandler(tornado.web.RequestHandler):
             return
 
         device = udid2device[udid]
-        await device.reset()
+
+        async def cold():
+            await device.reset()
+            await device.wait_ready()
+
+        await workqueue.run(device.serial, PRIORITY_COLD, cold)
         await hbconn.device_update({
             "udid": udid,
             "colding": False,
@@ -204,23 +662,261 @@ class ColdingHandler(tornado.web.RequestHandler):
         self.write({"success": True, "description": "Device colded"})
 
 
-def make_app():
+class DevicesHandler(CorsMixin, tornado.web.RequestHandler):
+    def get(self):
+        """ devices managed by this provider """
+        self.write({
+            "success": True,
+            "devices": [{
+                "udid": udid,
+                "serial": device.serial,
+                "provider": device.addrs(),
+                "readyTimes": device.ready_times,
+            } for udid, device in udid2device.items()],
+        })
+
+
+class ShellHandler(tornado.web.RequestHandler):
+    async def post(self):
+        """
+        run shell command on devices concurrently, at most --shell-concurrency
+        at the same time
+
+        Form: command, udid (can be repeated, default all devices), timeout
+        (seconds for each device). One json line is written for each device
+        as soon as it finishes.
+        """
+        if self.get_argument("secret", None) != secret:
+            self.set_status(403)
+            self.write({"success": False, "description": "Secret not match"})
+            return
+        command = self.get_argument("command")
+        timeout = float(self.get_argument("timeout", 10))
+        udids = self.get_arguments("udid") or list(udid2device)
+        limit = settings.shell_concurrency or len(udids)
+        semaphore = locks.Semaphore(max(1, limit))
+
+        async def run(udid: str) -> dict:
+            result = {"udid": udid, "success": False}
+            device = udid2device.get(udid)
+            if not device:
+                result['description'] = "Device not found"
+                return result
+            async with semaphore:
+                start = time.time()
+                try:
+                    result['output'] = await get_client(device.origin).shell(
+                        device.serial, command, timeout=timeout)
+                    result['success'] = True
+                except AdbTimeout:
+                    result['description'] = "Timeout after %gs" % timeout
+                except Exception as e:
+                    result['description'] = str(e)
+                result['elapsed'] = round(time.time() - start, 3)
+            return result
+
+        logger.info("Shell %r on %d devices", command, len(udids))
+        self.set_header("Content-Type", "application/x-ndjson")
+        if not udids:
+            return
+        it = gen.WaitIterator(*[gen.convert_yielded(run(u)) for u in udids])
+        while not it.done():
+            result = await it.next()
+            self.write(json.dumps(result) + "\n")
+            await self.flush()
+
+
+class LoopHandler(CorsMixin, tornado.web.RequestHandler):
+    def get(self):
+        """ IOLoop lag histogram and where it was blocked """
+        self.write(loopmonitor.report())
+
+
+async def load_stats() -> dict:
+    ports = set()
+    for device in udid2device.values():
+        ports.update(device.relay_ports())
+    return loadscore.collect(ports)
+
+
+class LoadHandler(CorsMixin, tornado.web.RequestHandler):
+    async def get(self):
+        """ load score which is advertised as priority """
+        self.write(loadscore.report(await load_stats()))
+
+
+def make_app(coordinator=None):
+    if coordinator:  # multi-process mode, devices live in workers
+        kwargs = {"coordinator": coordinator}
+        return tornado.web.Application([
+            (r"/app/install", ShardProxyHandler, kwargs),
+            (r"/app/upload", ShardUploadHandler, kwargs),
+            (r"/app/install/jobs/(\w+)", ShardJobHandler, kwargs),
+            (r"/app/install/jobs/(\w+)/progress", ShardJobProgressHandler,
+             kwargs),
+            (r"/cold", ShardProxyHandler, kwargs),
+            (r"/devices", ShardDevicesHandler, kwargs),
+            (r"/devices/([^/]+)/screen", ShardScreenHandler, kwargs),
+            (r"/devices/([^/]+)/thumbnail", ShardThumbnailHandler, kwargs),
+            (r"/devices/([^/]+)/logcat", ShardLogcatHandler, kwargs),
+            (r"/shell", ShardShellHandler, kwargs),
+            (r"/admin/loop", ShardLoopHandler, kwargs),
+            (r"/admin/load", ShardLoadHandler, kwargs),
+        ])
     app = tornado.web.Application([
         (r"/app/install", AppHandler),
+        (r"/app/upload", AppUploadHandler),
+        (r"/app/install/jobs/(\w+)", InstallJobHandler),
+        (r"/app/install/jobs/(\w+)/progress", InstallProgressHandler),
         (r"/cold", ColdingHandler),
+        (r"/devices", DevicesHandler),
+        (r"/devices/([^/]+)/screen", ScreenHandler),
+        (r"/devices/([^/]+)/thumbnail", ThumbnailHandler),
+        (r"/devices/([^/]+)/logcat", LogcatHandler),
+        (r"/shell", ShellHandler),
+        (r"/admin/loop", LoopHandler),
+        (r"/admin/load", LoadHandler),
     ])
     return app
 
 
-async def device_watch(allow_remote: bool = False):
+async def device_watch(allow_remote: bool = False,
+                       remove_delay: float = REMOVE_DELAY,
+                       events=None):
+    """
+    Args:
+        remove_delay: seconds to wait before reporting a removed device as
+            offline. If it comes back in time (e.g. USB glitch), the previous
+            AndroidDevice is reused instead of a full init.
+        events: async iterator of DeviceEvent, default adb.track_devices()
+    """
     serial2udid = {}
     udid2serial = {}
+    pending_removes = {}  # serial -> IOLoop timeout handle
+    initializing = {}  # serial -> AndroidDevice waiting for or in bring_up
 
     def callback(udid: str, status: str):
         if status == STATUS_OKAY:
             print("Good")
 
-    async for event in adb.track_devices():
+    async def bring_up(device: AndroidDevice):
+        try:
+            for retry in range(INIT_RETRIES, -1, -1):
+                try:
+                    await device.init(warm=settings.warm_start)
+                    if not device.agent_adopted:
+                        await device.open_identify()
+                    break
+                except AdbTimeout as e:
+                    device.close()
+                    if not retry:
+                        raise
+                    logger.warning(
+                        "Device:%s init timeout: %s, retry left %d",
+                        device.serial, e, retry)
+            try:
+                await device.wait_ready()
+            except InitError:
+                device.close()
+                raise
+        except (AdbTimeout, InitError):
+            # verified records may be stale, check everything next time
+            devicestore.forget(device.serial)
+            raise
+
+    async def add_device(udid: str, device: AndroidDevice):
+        """ runs in background, the event loop must not wait for the queue """
+        serial = device.serial
+
+        async def init():
+            if initializing.get(serial) is not device:
+                return False  # removed while waiting in queue
+            await bring_up(device)
+            return True
+
+        try:
+            if not await workqueue.run(serial, PRIORITY_BACKGROUND, init):
+                return
+            if initializing.get(serial) is not device:  # removed meanwhile
+                device.close()
+                return
+            initializing.pop(serial)
+            udid2device[udid] = device
+
+            await hbconn.device_update({
+                # "private": False, # TODO
+                "udid": udid,
+                "platform": "android",
+                "colding": False,
+                "provider": device.addrs(),
+                "properties": await device.properties(),
+            })  # yapf: disable
+            logger.info("Device:%s is ready", serial)
+        except (RuntimeError, AdbTimeout, InitError) as e:
+            logger.warning("Device:%s initialize failed: %s", serial, e)
+        except Exception as e:
+            logger.error("Unknown error: %s", e)
+            import traceback
+            traceback.print_exc()
+        finally:
+            if initializing.get(serial) is device:
+                initializing.pop(serial)
+
+    async def rejoin(event, device: AndroidDevice):
+        """ came back shortly after unplugged, try the fast path first """
+        serial = event.serial
+        udid = serial2udid[serial]
+
+        async def reconnect():
+            if initializing.get(serial) is not device:
+                return False  # removed while waiting in queue
+            if not await device.reconnect():
+                return False
+            await device.wait_ready()
+            return True
+
+        try:
+            ok = await workqueue.run(serial, PRIORITY_BACKGROUND, reconnect)
+        except Exception as e:
+            logger.warning("Device:%s reconnect failed: %s", serial, e)
+            ok = False
+        if initializing.get(serial) is not device:  # removed meanwhile
+            return
+        initializing.pop(serial)
+        if ok:
+            logger.info("Device:%s is back", serial)
+            return
+        device.close()
+        if udid2device.get(udid) is device:
+            udid2device.pop(udid)
+        new_device(event)
+
+    def new_device(event):
+        udid = serial2udid[event.serial] = event.serial
+        udid2serial[udid] = event.serial
+        device = AndroidDevice(event.serial, partial(callback, udid),
+                               event.origin, event.usb)
+        initializing[event.serial] = device
+        IOLoop.current().spawn_callback(add_device, udid, device)
+
+    async def device_offline(serial: str):
+        pending_removes.pop(serial, None)
+        device = initializing.pop(serial, None)
+        if device:
+            device.close()
+        udid = serial2udid[serial]
+        if udid in udid2device:
+            udid2device[udid].close()
+            udid2device.pop(udid, None)
+        thumbnails.forget(udid)
+        logcats.forget(udid)
+
+        await hbconn.device_update({
+            "udid": udid,
+            "provider": None,  # not present
+        })
+
+    async for event in events or adb.track_devices():
         logger.debug("%s", event)
         # udid = event.serial  # FIXME(ssx): fix later
         if not allow_remote:
@@ -228,42 +924,70 @@ async def device_watch(allow_remote: bool = False):
                 logger.debug("Skip remote device: %s", event)
                 continue
         if event.present:
-            try:
-                udid = serial2udid[event.serial] = event.serial
-                udid2serial[udid] = event.serial
-
-                device = AndroidDevice(event.serial, partial(callback, udid))
-
-                await device.init()
-                await device.open_identify()
-
-                udid2device[udid] = device
-
-                await hbconn.device_update({
-                    # "private": False, # TODO
-                    "udid": udid,
-                    "platform": "android",
-                    "colding": False,
-                    "provider": device.addrs(),
-                    "properties": await device.properties(),
-                })  # yapf: disable
-                logger.info("Device:%s is ready", event.serial)
-            except RuntimeError:
-                logger.warning("Device:%s initialize failed", event.serial)
-            except Exception as e:
-                logger.error("Unknown error: %s", e)
-                import traceback
-                traceback.print_exc()
-        else:
-            udid = serial2udid[event.serial]
-            if udid in udid2device:
-                udid2device[udid].close()
-                udid2device.pop(udid, None)
+            timeout = pending_removes.pop(event.serial, None)
+            if timeout:
+                IOLoop.current().remove_timeout(timeout)
+                udid = serial2udid[event.serial]
+                device = initializing.pop(event.serial, None)
+                if device:  # came back while initializing, start over
+                    device.close()
+                    if udid2device.get(udid) is device:  # was rejoining
+                        udid2device.pop(udid)
+                device = udid2device.get(udid)
+                if device:
+                    initializing[event.serial] = device
+                    IOLoop.current().spawn_callback(rejoin, event, device)
+                    continue
+            elif event.serial in initializing:
+                logger.debug("Device:%s is initializing", event.serial)
+                continue
 
-            await hbconn.device_update({
-                "udid": udid,
-                "provider": None,  # not present
-            })
+            new_device(event)
+        elif event.serial in serial2udid and event.serial not in pending_removes:
+            logger.debug("Device:%s removed, wait %.1fs before offline",
+                         event.serial, remove_delay)
+            pending_removes[event.serial] = IOLoop.current().call_later(
+                remove_delay, device_offline, event.serial)
+
+
+async def track_present(events, seen: set):
+    """ pass events through, remember serials ever present """
+    async for event in events:
+        if event.present:
+            seen.add(event.serial)
+        yield event
+
+
+def run_worker(index: int, ipc_port: int, http_port: int, options: dict):
+    """ entry of worker process in multi-process mode """
+    IOLoop.current().run_sync(
+        partial(async_worker, index, ipc_port, http_port, options))
+
+
+async def async_worker(index: int, ipc_port: int, http_port: int,
+                       options: dict):
+    global hbconn, secret
+    settings.atx_agent_version = options['atx_agent_version']
+    settings.warm_start = options['warm_start']
+    freeport.set_range(*port_block(index + 1))
+    scheduler.limit = options['usb_transfers']
+    workqueue.budget = options['max_jobs']
+    settings.device_apk_cache_size = options['apk_cache_size'] << 20
+    settings.push_compress = options['push_compress']
+    settings.apk_url_ttl = options['apk_url_ttl']
+    thumbnails.interval = options['thumbnail_interval']
+    logcats.size = options['logcat_lines']
+    settings.shell_concurrency = options['shell_concurrency']
+    loopmonitor.threshold = options['block_threshold']
+    loopmonitor.start()
+    secret = options['secret']
+
+    app = make_app()
+    app.listen(http_port, "127.0.0.1")
+
+    hbconn = await WorkerChannel.connect(index, ipc_port)
+    await device_watch(options['allow_remote'], options['remove_delay'],
+                       hbconn.events())
 
 
 async def async_main():
@@ -277,10 +1001,38 @@ async def async_main():
     parser.add_argument("--atx-agent-version", default=u2.version.__atx_agent_version__, help="set atx-agent version")
     parser.add_argument("--owner", type=str, help="provider owner email")
     parser.add_argument("--owner-file", type=argparse.FileType("r"), help="provider owner email from file")
+    parser.add_argument("--warm-start", action="store_true", help="adopt forwards, proxies and atx-agent of previous provider process")
+    parser.add_argument("--remove-delay", type=float, default=REMOVE_DELAY, help="seconds before a removed device is reported offline")
+    parser.add_argument("--adb-server", action="append", help="adb server address host:port, can be set multiple times, default from env ANDROID_ADB_SERVER_HOST/PORT")
+    parser.add_argument("--usb-transfers", type=int, default=2, help="max concurrent pushes and installs behind one usb hub, 0 means no limit")
+    parser.add_argument("--max-jobs", type=int, default=4, help="max device jobs (install, cold, init) running at the same time, 0 means no limit")
+    parser.add_argument("--apk-cache-size", type=int, default=settings.device_apk_cache_size >> 20, help="MB of apks cached on each device, 0 to disable")
+    parser.add_argument("--push-compress", choices=("never", "auto", "always"), default=settings.push_compress, help="push large files gzip compressed and decompress on device, auto decides by compress ratio and link speed")
+    parser.add_argument("--block-threshold", type=float, default=loopmonitor.threshold, help="seconds the IOLoop is blocked before the stack is captured, see /admin/loop, 0 to disable")
+    parser.add_argument("--apk-url-ttl", type=float, default=settings.apk_url_ttl, help="seconds an apk downloaded by /app/install is used without asking the server whether it changed")
+    parser.add_argument("--priority", type=int, default=2, help="provider priority sent to server, the larger the importanter")
+    parser.add_argument("--dynamic-priority", action="store_true", help="compute priority (1-%d) from load of cpu, relays, jobs and usb, and update it when load changes" % loadscore.MAX_PRIORITY)
+    parser.add_argument("--thumbnail-interval", type=float, default=thumbnails.interval, help="seconds between screenshots of a device for /devices/{udid}/thumbnail")
+    parser.add_argument("--logcat-lines", type=int, default=logcats.size, help="logcat lines kept per device for /devices/{udid}/logcat")
+    parser.add_argument("--shell-concurrency", type=int, default=settings.shell_concurrency, help="max devices running a /shell command at the same time (per worker), 0 means no limit")
+    parser.add_argument("--workers", type=int, default=0, help="number of worker processes devices are spread to, 0 means single process")
     args = parser.parse_args()
     # yapf: enable
+    if port_block(args.workers)[1] > 65535:
+        parser.error("too many workers, no free ports left for them")
 
     settings.atx_agent_version = args.atx_agent_version
+    settings.warm_start = args.warm_start
+    scheduler.limit = args.usb_transfers
+    workqueue.budget = args.max_jobs
+    settings.device_apk_cache_size = args.apk_cache_size << 20
+    settings.push_compress = args.push_compress
+    settings.apk_url_ttl = args.apk_url_ttl
+    thumbnails.interval = args.thumbnail_interval
+    logcats.size = args.logcat_lines
+    settings.shell_concurrency = args.shell_concurrency
+    loopmonitor.threshold = args.block_threshold
+    loopmonitor.start()
 
     owner_email = args.owner
     if args.owner_file:
@@ -299,7 +1051,26 @@ async def async_main():
 
     # start local server
     provider_url = "http://" + current_ip() + ":" + str(args.port)
-    app = make_app()
+    coordinator = None
+    if args.workers > 0:
+        coordinator = Coordinator(
+            args.workers, run_worker, {
+                "atx_agent_version": args.atx_agent_version,
+                "warm_start": args.warm_start,
+                "secret": secret,
+                "allow_remote": args.allow_remote,
+                "remove_delay": args.remove_delay,
+                "usb_transfers": args.usb_transfers,
+                "max_jobs": args.max_jobs,
+                "apk_cache_size": args.apk_cache_size,
+                "push_compress": args.push_compress,
+                "apk_url_ttl": args.apk_url_ttl,
+                "block_threshold": args.block_threshold,
+                "thumbnail_interval": args.thumbnail_interval,
+                "logcat_lines": args.logcat_lines,
+                "shell_concurrency": args.shell_concurrency,
+            })
+    app = make_app(coordinator)
     app.listen(args.port)
     logger.info("ProviderURL: %s", provider_url)
 
@@ -307,12 +1078,33 @@ async def async_main():
 
     # connect to atxserver2
     global hbconn
+    stats_func = coordinator.load_stats if coordinator else load_stats
+    priority = args.priority
+    if args.dynamic_priority:
+        priority = loadscore.to_priority(loadscore.score(await stats_func()))
     hbconn = await heartbeat_connect(args.server,
                                      secret=secret,
                                      self_url=provider_url,
+                                     priority=priority,
                                      owner=owner_email)
+    if args.dynamic_priority:
+        IOLoop.current().spawn_callback(loadscore.advertise, hbconn,
+                                        stats_func)
+
+    if args.adb_server:
+        clients = [get_client(addr) for addr in args.adb_server]
+        events = track_devices_all(clients)
+    else:
+        events = adb.track_devices()
+    seen = set()
+    events = track_present(events, seen)
+    IOLoop.current().call_later(ORPHAN_DELAY, stop_orphans, seen)
 
-    await device_watch(args.allow_remote)
+    if coordinator:
+        coordinator.start(hbconn)
+        await coordinator.watch(events)
+    else:
+        await device_watch(args.allow_remote, args.remove_delay, events)
 
 
 async def test_asyncadb():
@@ -2,3 +2,10 @@
 #
 
 atx_agent_version = ""  # set from command line
+warm_start = False  # set from command line
+state_db_path = "device-state.db"  # sqlite file of core.devicestore
+max_upload_size = 4 << 30  # bytes, limit of /app/upload body
+device_apk_cache_size = 1 << 30  # bytes, budget of apks cached on each device
+push_compress = "never"  # compress large pushes: never, auto or always
+apk_url_ttl = 0.0  # seconds a downloaded apk is used before revalidation
+shell_concurrency = 16  # devices running a /shell command at the same time
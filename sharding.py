@@ -0,0 +1,641 @@
+# coding: utf-8
+#
+# Multi-process mode for hosts with lots of devices.
+#
+# The coordinator process owns track-devices, the heartbeat connection and
+# the public http port. Devices are handed to worker processes by consistent
+# hashing on their usb hub (serial when the hub is unknown), so the per hub
+# transfer limit of core.transfer holds across workers. Each worker runs the
+# normal device_watch and http
+# handlers, and talks to the coordinator with json lines over a local tcp
+# connection:
+#
+#   worker -> coordinator
+#       {"command": "hello", "index": 0}
+#       {"command": "update", "data": {...}}    # heartbeat device_update
+#   coordinator -> worker
+#       {"command": "event", "present": true, "serial": "xxx",
+#        "status": "device", "origin": "127.0.0.1:5037", "usb": "1-1.4"}
+
+import bisect
+import collections
+import hashlib
+import json
+import multiprocessing
+import time
+import urllib.parse
+
+import tornado.web
+from logzero import logger
+from tornado import gen, websocket
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.netutil import bind_sockets
+from tornado.queues import Queue
+from tornado.tcpclient import TCPClient
+from tornado.tcpserver import TCPServer
+
+from asyncadb import DeviceEvent, adb
+from device import stop_helpers
+from core import loadscore
+from core.cors import CorsMixin
+from core.freeport import freeport
+from core.transfer import usb_hub
+from core.looplag import loopmonitor
+from core.screenhub import Subscriber, screenhub
+import settings
+
+PORT_BLOCK = 2000  # free ports of each process
+
+
+def port_block(index: int):
+    """
+    disjoint free port ranges, so that processes do not take the same port.
+    0 is the coordinator, worker N uses N + 1
+
+    Returns:
+        (start, end)
+    """
+    start = 20000 + PORT_BLOCK * index
+    return start, start + PORT_BLOCK - 1
+
+
+async def write_json(stream, message: dict):
+    await stream.write(json.dumps(message).encode('utf-8') + b"\n")
+
+
+async def read_json(stream) -> dict:
+    return json.loads((await stream.read_until(b"\n")).decode('utf-8'))
+
+
+class HashRing(object):
+    """ consistent hashing, moving a few serials when workers change """
+
+    def __init__(self, nodes: list, replicas: int = 64):
+        ring = []
+        for node in nodes:
+            for i in range(replicas):
+                ring.append((self._hash("%s-%d" % (node, i)), node))
+        ring.sort()
+        self._keys = [h for h, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16)
+
+    def get(self, key: str):
+        i = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._nodes[i]
+
+
+class WorkerChannel(object):
+    """
+    worker side of the ipc connection, it also takes the place of
+    HeartbeatConnection inside worker process
+    """
+
+    def __init__(self, index: int, stream):
+        self._index = index
+        self._stream = stream
+
+    @classmethod
+    async def connect(cls, index: int, ipc_port: int):
+        stream = await TCPClient().connect("127.0.0.1", ipc_port)
+        await write_json(stream, {"command": "hello", "index": index})
+        return cls(index, stream)
+
+    async def device_update(self, data: dict):
+        await write_json(self._stream, {"command": "update", "data": data})
+
+    async def events(self):
+        """ yield DeviceEvent dispatched by coordinator """
+        while True:
+            message = await read_json(self._stream)
+            if message.get("command") == "event":
+                yield DeviceEvent(message['present'], message['serial'],
+                                  message['status'], message.get('origin'),
+                                  message.get('usb'))
+
+
+class _IPCServer(TCPServer):
+    def __init__(self, coordinator):
+        super().__init__()
+        self._coordinator = coordinator
+
+    async def handle_stream(self, stream, address):
+        await self._coordinator.handle_worker(stream)
+
+
+class Coordinator(object):
+    """
+    Args:
+        num_workers: number of worker processes
+        target: picklable func(index, ipc_port, http_port, options) which
+            runs in worker process
+        options: picklable dict passed to target
+    """
+
+    def __init__(self, num_workers: int, target, options: dict):
+        self._target = target
+        self._options = options
+        self._ring = HashRing(list(range(num_workers)))
+        freeport.set_range(*port_block(0))
+        self._http_ports = [freeport.get() for _ in range(num_workers)]
+        self._streams = {}  # index -> IOStream
+        self._procs = {}  # index -> Process
+        self._serials = {}  # serial -> index, devices present
+        self._events = {}  # serial -> DeviceEvent, devices present
+        self._jobs = collections.OrderedDict()  # job id -> worker url
+        self._ipc_port = None
+        self._hbconn = None
+
+    def start(self, hbconn):
+        self._hbconn = hbconn
+        sockets = bind_sockets(0, "127.0.0.1")
+        self._ipc_port = sockets[0].getsockname()[1]
+        _IPCServer(self).add_sockets(sockets)
+        for index in range(len(self._http_ports)):
+            self._spawn(index)
+
+    def _spawn(self, index: int):
+        # spawn, forking a process with a running IOLoop is not safe
+        ctx = multiprocessing.get_context("spawn")
+        p = ctx.Process(target=self._target,
+                        args=(index, self._ipc_port, self._http_ports[index],
+                              self._options),
+                        daemon=True)
+        p.start()
+        self._procs[index] = p
+        logger.info("Worker %d started, pid: %d, http port: %d", index, p.pid,
+                    self._http_ports[index])
+
+    async def handle_worker(self, stream):
+        try:
+            hello = await read_json(stream)
+        except (StreamClosedError, ValueError):
+            stream.close()
+            return
+        index = hello['index']
+        self._streams[index] = stream
+        logger.info("Worker %d connected", index)
+
+        # replay devices owned by this worker, needed after a restart
+        for serial, owner in list(self._serials.items()):
+            if owner == index:
+                await self._send(index, self._events[serial])
+        try:
+            while True:
+                message = await read_json(stream)
+                if message.get("command") == "update":
+                    await self._hbconn.device_update(message['data'])
+        except StreamClosedError:
+            pass
+        self._streams.pop(index, None)
+        logger.warning("Worker %d disconnected, restart after 1s", index)
+        await self._stop(index)
+        await gen.sleep(1)
+        self._spawn(index)
+
+    async def _stop(self, index: int, timeout: float = 5.0):
+        """
+        wait for the worker process to exit without blocking IOLoop, kill
+        it when it hangs, so that the new worker can listen on its port
+        """
+        p = self._procs[index]
+        deadline = time.time() + timeout
+        while p.is_alive() and time.time() < deadline:
+            await gen.sleep(.1)
+        if p.is_alive():
+            logger.warning("Worker %d pid %d hangs, terminate", index, p.pid)
+            p.terminate()
+            await gen.sleep(1)
+            if p.is_alive():
+                p.kill()
+                while p.is_alive():
+                    await gen.sleep(.1)
+        p.join(timeout=0)  # reap
+        # helpers (tcpproxy, adbkit) outlive the worker, the new one starts
+        # its own when the devices are replayed
+        stop_helpers({
+            serial
+            for serial, owner in self._serials.items() if owner == index
+        })
+
+    async def _send(self, index: int, event: DeviceEvent):
+        stream = self._streams.get(index)
+        if not stream:  # replayed when worker connected
+            return
+        await write_json(stream, {
+            "command": "event",
+            "present": event.present,
+            "serial": event.serial,
+            "status": event.status,
+            "origin": event.origin,
+            "usb": event.usb,
+        })
+
+    async def watch(self, events=None):
+        """
+        Args:
+            events: async iterator of DeviceEvent, default adb.track_devices()
+        """
+        async for event in events or adb.track_devices():
+            index = self._serials.get(event.serial)
+            if event.present or index is None:
+                index = self._ring.get(self.shard_key(event))
+            logger.debug("%s -> worker %d", event, index)
+            if event.present:
+                self._serials[event.serial] = index
+                self._events[event.serial] = event
+            else:
+                self._serials.pop(event.serial, None)
+                self._events.pop(event.serial, None)
+            try:
+                await self._send(index, event)
+            except StreamClosedError:
+                logger.warning("Worker %d is down, %s will be replayed",
+                               index, event.serial)
+
+    def shard_key(self, event: DeviceEvent) -> str:
+        """ devices behind one usb hub go to the same worker """
+        hub = usb_hub(event.usb)
+        if hub:
+            return "%s/%s" % (event.origin or "", hub)
+        return event.serial
+
+    def worker_url(self, udid: str):
+        """ udid is the same as serial for now """
+        index = self._serials.get(udid)
+        if index is None:
+            return None
+        return "http://127.0.0.1:%d" % self._http_ports[index]
+
+    def add_job_of(self, response, worker_url: str):
+        """ remember worker of the job created by install response """
+        job_id = json.loads(response.body).get("jobId")
+        if not job_id:
+            return
+        self._jobs[job_id] = worker_url
+        while len(self._jobs) > 10000:
+            self._jobs.popitem(last=False)
+
+    def job_worker_url(self, job_id: str):
+        return self._jobs.get(job_id)
+
+    @property
+    def secret(self) -> str:
+        return self._options.get("secret")
+
+    def worker_urls(self) -> list:
+        return ["http://127.0.0.1:%d" % port for port in self._http_ports]
+
+    async def load_stats(self) -> dict:
+        """ load stats of all workers, see core.loadscore """
+        responses = await gen.multi([
+            AsyncHTTPClient().fetch(url + "/admin/load", raise_error=False)
+            for url in self.worker_urls()
+        ])
+        stats = [{"cpu": loadscore.cpu_load()}]
+        for r in responses:
+            if r.code == 200:
+                stats.append(json.loads(r.body)['stats'])
+        return loadscore.merge(stats)
+
+
+class ShardProxyHandler(CorsMixin, tornado.web.RequestHandler):
+    """ forward device requests to the worker which owns the device """
+
+    def initialize(self, coordinator: Coordinator):
+        self._coordinator = coordinator
+
+    async def post(self):
+        base_url = self._coordinator.worker_url(self.get_argument("udid"))
+        if not base_url:
+            self.set_status(404)
+            self.write({"success": False, "description": "Device not found"})
+            return
+        r = await AsyncHTTPClient().fetch(base_url + self.request.uri,
+                                          method="POST",
+                                          body=self.request.body,
+                                          headers=self.request.headers,
+                                          request_timeout=3600,
+                                          raise_error=False)
+        if r.code == 200:
+            self._coordinator.add_job_of(r, base_url)
+        copy_response(self, r)
+
+
+@tornado.web.stream_request_body
+class ShardUploadHandler(CorsMixin, tornado.web.RequestHandler):
+    """ stream request body to the worker which owns the device """
+
+    def initialize(self, coordinator: Coordinator):
+        self._coordinator = coordinator
+
+    def prepare(self):
+        if self.request.method != "POST":
+            return
+        self._base_url = self._coordinator.worker_url(
+            self.get_argument("udid"))
+        if not self._base_url:
+            raise tornado.web.HTTPError(404, "Device not found")
+        self.request.connection.set_max_body_size(settings.max_upload_size)
+        self.request.connection.set_body_timeout(3600)
+
+        headers = {}
+        if "Content-Length" in self.request.headers:
+            headers['Content-Length'] = self.request.headers['Content-Length']
+        self._chunks = Queue(maxsize=4)
+        self._response = AsyncHTTPClient().fetch(
+            self._base_url + self.request.uri,
+            method="POST",
+            headers=headers,
+            body_producer=self._produce_body,
+            request_timeout=3600,
+            raise_error=False)
+
+    async def _produce_body(self, write):
+        while True:
+            chunk = await self._chunks.get()
+            if chunk is None:
+                return
+            await write(chunk)
+
+    async def data_received(self, chunk: bytes):
+        await self._chunks.put(chunk)
+
+    async def post(self):
+        await self._chunks.put(None)
+        r = await self._response
+        if r.code == 200:
+            self._coordinator.add_job_of(r, self._base_url)
+        copy_response(self, r)
+
+
+def copy_response(handler: tornado.web.RequestHandler, r):
+    handler.set_status(r.code)
+    for name, value in r.headers.get_all():
+        if name in ("Content-Type", "Etag", "Cache-Control") or \
+                name.startswith("Access-Control-"):
+            handler.set_header(name, value)
+    if r.body:  # no body allowed for 304
+        handler.write(r.body)
+
+
+class ShardJobHandler(CorsMixin, tornado.web.RequestHandler):
+    def initialize(self, coordinator: Coordinator):
+        self._coordinator = coordinator
+
+    async def get(self, job_id: str):
+        base_url = self._coordinator.job_worker_url(job_id)
+        if not base_url:
+            self.set_status(404)
+            self.write({"success": False, "description": "Job not found"})
+            return
+        r = await AsyncHTTPClient().fetch(base_url + self.request.uri,
+                                          raise_error=False)
+        copy_response(self, r)
+
+
+class RelayMixin(object):
+    """
+    relay messages of a worker websocket. It runs in background, so that
+    open() returns and on_close is called when the client leaves
+    """
+    _upstream = None
+
+    def relay(self, url: str):
+        IOLoop.current().spawn_callback(self._relay, url)
+
+    async def _relay(self, url: str):
+        try:
+            self._upstream = await websocket.websocket_connect(url)
+        except Exception as e:
+            logger.warning("Relay %s: %s", url, e)
+            self.close(1011, "Worker unavailable")
+            return
+        if self.ws_connection is None:  # client left while connecting
+            self._upstream.close()
+            return
+        while True:
+            message = await self._upstream.read_message()
+            if message is None:
+                break
+            try:
+                await self.write_message(message)
+            except websocket.WebSocketClosedError:
+                break
+        self.close(self._upstream.close_code, self._upstream.close_reason)
+
+    def on_close(self):
+        if self._upstream:
+            self._upstream.close()
+
+
+class ShardJobProgressHandler(RelayMixin, websocket.WebSocketHandler):
+    """ relay job progress websocket of worker """
+
+    def initialize(self, coordinator: Coordinator):
+        self._coordinator = coordinator
+
+    def check_origin(self, origin):
+        return True
+
+    def open(self, job_id: str):
+        base_url = self._coordinator.job_worker_url(job_id)
+        if not base_url:
+            self.close(4004, "Job not found")
+            return
+        self.relay("ws" + base_url[len("http"):] + self.request.uri)
+
+
+class ShardScreenHandler(websocket.WebSocketHandler):
+    """
+    screen stream of the worker which owns the device, shared by viewers
+    connected to coordinator so the worker sees only one of them
+    """
+
+    def initialize(self, coordinator: Coordinator):
+        self._coordinator = coordinator
+        self._stream = None
+        self._subscriber = Subscriber(self)
+
+    def check_origin(self, origin):
+        return True
+
+    def open(self, udid: str):
+        base_url = self._coordinator.worker_url(udid)
+        if not base_url:
+            self.close(4004, "Device not found")
+            return
+        url = "ws" + base_url[len("http"):] + "/devices/%s/screen" % udid
+        self._stream = screenhub.stream(udid, url)
+        self._stream.subscribe(self._subscriber)
+
+    def on_close(self):
+        if self._stream:
+            self._stream.unsubscribe(self._subscriber)
+
+
+class ShardLogcatHandler(RelayMixin, websocket.WebSocketHandler):
+    """
+    relay logcat websocket of worker, filters are applied by the worker
+    which reads logcat of the device only once
+    """
+
+    def initialize(self, coordinator: Coordinator):
+        self._coordinator = coordinator
+
+    def check_origin(self, origin):
+        return True
+
+    def open(self, udid: str):
+        base_url = self._coordinator.worker_url(udid)
+        if not base_url:
+            self.close(4004, "Device not found")
+            return
+        self.relay("ws" + base_url[len("http"):] + self.request.uri)
+
+
+class ShardThumbnailHandler(CorsMixin, tornado.web.RequestHandler):
+    def initialize(self, coordinator: Coordinator):
+        self._coordinator = coordinator
+
+    async def get(self, udid: str):
+        base_url = self._coordinator.worker_url(udid)
+        if not base_url:
+            self.set_status(404)
+            self.write({"success": False, "description": "Device not found"})
+            return
+        headers = {}
+        if "If-None-Match" in self.request.headers:
+            headers['If-None-Match'] = self.request.headers['If-None-Match']
+        r = await AsyncHTTPClient().fetch(base_url + self.request.uri,
+                                          headers=headers,
+                                          raise_error=False)
+        copy_response(self, r)
+
+
+class ShardShellHandler(tornado.web.RequestHandler):
+    """ run /shell on workers which own the devices, merge their lines """
+
+    def initialize(self, coordinator: Coordinator):
+        self._coordinator = coordinator
+
+    async def post(self):
+        if self.get_argument("secret", None) != self._coordinator.secret:
+            self.set_status(403)
+            self.write({"success": False, "description": "Secret not match"})
+            return
+        self.set_header("Content-Type", "application/x-ndjson")
+        udids = self.get_arguments("udid")
+        groups = {}  # worker url -> udids, empty means all devices
+        if udids:
+            for udid in udids:
+                base_url = self._coordinator.worker_url(udid)
+                if base_url:
+                    groups.setdefault(base_url, []).append(udid)
+                else:
+                    self.write(json.dumps({
+                        "udid": udid,
+                        "success": False,
+                        "description": "Device not found"
+                    }) + "\n")
+        else:
+            groups = {url: [] for url in self._coordinator.worker_urls()}
+        await self.flush()
+
+        args = [("secret", self._coordinator.secret),
+                ("command", self.get_argument("command")),
+                ("timeout", self.get_argument("timeout", "10"))]
+
+        async def relay(base_url: str, udids: list):
+            pending = b""
+            status = None
+
+            def on_header(line: str):
+                nonlocal status
+                if line.startswith("HTTP/"):
+                    status = int(line.split()[1])
+
+            def on_chunk(chunk: bytes):
+                nonlocal pending
+                if status != 200:  # error page, not result lines
+                    return
+                data = pending + chunk
+                end = data.rfind(b"\n") + 1  # whole lines only
+                pending = data[end:]
+                if end:
+                    self.write(data[:end])
+                    self.flush()
+
+            body = urllib.parse.urlencode(args + [("udid", u) for u in udids])
+            r = await AsyncHTTPClient().fetch(base_url + "/shell",
+                                              method="POST",
+                                              body=body,
+                                              header_callback=on_header,
+                                              streaming_callback=on_chunk,
+                                              request_timeout=3600,
+                                              raise_error=False)
+            if r.code != 200:
+                logger.warning("worker %s /shell: %s", base_url, r.code)
+                for udid in udids:
+                    self.write(json.dumps({
+                        "udid": udid,
+                        "success": False,
+                        "description": "Worker error: %s" % r.code
+                    }) + "\n")
+
+        await gen.multi([relay(url, u) for url, u in groups.items()])
+
+
+class ShardDevicesHandler(CorsMixin, tornado.web.RequestHandler):
+    """ merge /devices of all workers """
+
+    def initialize(self, coordinator: Coordinator):
+        self._coordinator = coordinator
+
+    async def get(self):
+        responses = await gen.multi([
+            AsyncHTTPClient().fetch(url + "/devices", raise_error=False)
+            for url in self._coordinator.worker_urls()
+        ])
+        devices = []
+        for r in responses:
+            if r.code == 200:
+                devices.extend(json.loads(r.body)['devices'])
+        self.set_header("Access-Control-Allow-Origin", "*")
+        self.write({"success": True, "devices": devices})
+
+
+class ShardLoopHandler(CorsMixin, tornado.web.RequestHandler):
+    """ IOLoop report of coordinator and every worker """
+
+    def initialize(self, coordinator: Coordinator):
+        self._coordinator = coordinator
+
+    async def get(self):
+        responses = await gen.multi([
+            AsyncHTTPClient().fetch(url + "/admin/loop", raise_error=False)
+            for url in self._coordinator.worker_urls()
+        ])
+        self.set_header("Access-Control-Allow-Origin", "*")
+        self.write({
+            "coordinator": loopmonitor.report(),
+            "workers": [
+                json.loads(r.body) if r.code == 200 else None
+                for r in responses
+            ],
+        })
+
+
+class ShardLoadHandler(CorsMixin, tornado.web.RequestHandler):
+    def initialize(self, coordinator: Coordinator):
+        self._coordinator = coordinator
+
+    async def get(self):
+        stats = await self._coordinator.load_stats()
+        self.set_header("Access-Control-Allow-Origin", "*")
+        self.write(loadscore.report(stats))